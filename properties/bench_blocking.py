@@ -0,0 +1,78 @@
+# bench_blocking.py
+#
+# Compares the bytes, requests and load time of property pages loaded with
+# each resource blocking profile, and checks that __NEXT_DATA__ and the
+# saleMap response still come through.
+#
+# Usage: python properties/bench_blocking.py [--profiles off assets strict] [--repeat 3] [link ...]
+
+import argparse
+import time
+
+from utils import BLOCKING_PROFILES, page_transfer, reset_capture, setup_driver
+from readiness import wait_for_next_data, wait_for_sale_map
+from fetch import rebase_url
+
+# Sold listing used when no links are given
+DEFAULT_LINK = ('https://www.hemnet.se/salda/lagenhet-2rum-sjungande-dalen-skelleftea-kommun-'
+                'orkestervagen-112-3537267266547361298')
+
+
+def load_page(driver, link):
+    """
+    Loads a property page and waits for the data the scraper reads. Returns
+    the seconds until both arrived, the bytes and requests of the page, and
+    whether __NEXT_DATA__ and the saleMap response were found.
+    """
+    reset_capture(driver)
+    start = time.perf_counter()
+    driver.get(rebase_url(link))
+    next_data = wait_for_next_data(driver) is not None
+    sale_map = wait_for_sale_map(driver) is not None
+    seconds = time.perf_counter() - start
+    transferred, requests = page_transfer(driver) or (0, 0)
+    return seconds, transferred, requests, next_data, sale_map
+
+
+def bench(block, links, repeat):
+    driver = setup_driver(block=block)
+    try:
+        # The first load fills the HTTP cache, every profile starts from it warm
+        load_page(driver, links[0])
+        pages = [load_page(driver, link) for _ in range(repeat) for link in links]
+    finally:
+        driver.quit()
+    count = len(pages)
+    return {
+        'seconds': sum(page[0] for page in pages) / count,
+        'kilobytes': sum(page[1] for page in pages) / count / 1024,
+        'requests': sum(page[2] for page in pages) / count,
+        'next_data': sum(page[3] for page in pages) / count,
+        'sale_map': sum(page[4] for page in pages) / count,
+    }
+
+
+def main(profiles, links, repeat):
+    print(f"{len(links)} pages, {repeat} loads each per profile")
+    print(f"{'profile':<10} {'load s':>8} {'kB':>10} {'requests':>9} {'next_data':>10} {'saleMap':>8}")
+    results = {}
+    for block in profiles:
+        results[block] = stats = bench(block, links, repeat)
+        print(f"{block:<10} {stats['seconds']:8.2f} {stats['kilobytes']:10.1f} {stats['requests']:9.1f} "
+              f"{stats['next_data']:10.0%} {stats['sale_map']:8.0%}")
+    if 'off' in results:
+        baseline = results['off']
+        for block, stats in results.items():
+            if block != 'off' and stats['kilobytes']:
+                print(f"{block}: {baseline['kilobytes'] / stats['kilobytes']:.1f}x fewer bytes, "
+                      f"{baseline['seconds'] / stats['seconds']:.2f}x faster than off")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare page loads across resource blocking profiles.')
+    parser.add_argument('links', nargs='*', default=[DEFAULT_LINK], help='Property page links to load')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(BLOCKING_PROFILES),
+                        default=['off', 'assets', 'strict'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.profiles, args.links, args.repeat)
@@ -0,0 +1,210 @@
+# bench_extract.py
+#
+# Micro-benchmark of the compiled extractor in extract.py against the
+# hand-written extraction it replaced, on saved __NEXT_DATA__ payloads.
+#
+# Usage: python properties/bench_extract.py <directory of *.json payloads>
+
+import argparse
+import glob
+import json
+import os
+import timeit
+
+from extract import loads, parse_next_data, parse_property_info
+
+
+def legacy_parse_property_info(data):
+    """
+    The hand-written extraction that the compiled extractor replaced, kept
+    as the baseline of the benchmark.
+    """
+    # Navigate through the JSON data to extract property information
+    try:
+        apollo_state = data['props']['pageProps']['__APOLLO_STATE__']
+        # The property ID is under 'SoldPropertyListing:<ID>'
+        # Extract the ID dynamically
+        for key in apollo_state.keys():
+            if key.startswith('SoldPropertyListing:'):
+                property_data = apollo_state[key]
+                break
+        else:
+            return {}
+    except KeyError:
+        return {}
+    
+    # Collect all property data
+    property_info = {}
+    
+    # Exclude image data and ad targeting
+    excluded_keys = ['attributedImages', 'adTargeting']
+
+    for key, value in property_data.items():
+        if key in excluded_keys:
+            continue
+
+        # Handle nested references
+        if isinstance(value, dict) and '__ref' in value:
+            ref_key = value['__ref']
+            referenced_data = apollo_state.get(ref_key, {})
+            property_info[key] = referenced_data
+        elif isinstance(value, list):
+            # For lists, process each item
+            processed_list = []
+            for item in value:
+                if isinstance(item, dict) and '__ref' in item:
+                    ref_key = item['__ref']
+                    referenced_data = apollo_state.get(ref_key, {})
+                    processed_list.append(referenced_data)
+                else:
+                    processed_list.append(item)
+            property_info[key] = processed_list
+        else:
+            property_info[key] = value
+
+    # Process nested fields and dereference as necessary
+    # (Same as previous code)
+    # Process 'broker' and 'brokerAgency'
+    if 'broker' in property_info and property_info['broker']:
+        broker_data = property_info['broker']
+        property_info['broker'] = {
+            'name': broker_data.get('name', ''),
+            'email': broker_data.get('email', ''),
+            'phoneNumber': broker_data.get('phoneNumber', ''),
+            'description': broker_data.get('description', ''),
+            'id': broker_data.get('id', ''),
+            'slug': broker_data.get('slug', ''),
+            'hasActiveProfile': broker_data.get('hasActiveProfile', False),
+            'canonicalUrl': broker_data.get('canonicalUrl', '')
+        }
+
+    if 'brokerAgency' in property_info and property_info['brokerAgency']:
+        agency_data = property_info['brokerAgency']
+        property_info['brokerAgency'] = {
+            'id': agency_data.get('id', ''),
+            'name': agency_data.get('name', ''),
+            'phoneNumber': agency_data.get('phoneNumber', ''),
+            'email': agency_data.get('email', ''),
+            'websiteUrl': agency_data.get('websiteUrl', ''),
+            'slug': agency_data.get('slug', ''),
+            'offersSellingPrices': agency_data.get('offersSellingPrices', False),
+            'isKronofogden': agency_data.get('isKronofogden', False),
+            'developer': agency_data.get('developer', False)
+        }
+
+    # Process 'districts'
+    if 'districts' in property_info and property_info['districts']:
+        districts_list = []
+        for district in property_info['districts']:
+            district_data = district
+            districts_list.append({
+                'id': district_data.get('id', ''),
+                'fullName': district_data.get('fullName', ''),
+                '__typename': district_data.get('__typename', '')
+            })
+        property_info['districts'] = districts_list
+
+    # Process 'municipality' and 'county'
+    for loc_field in ['municipality', 'county']:
+        if loc_field in property_info and property_info[loc_field]:
+            loc_data = property_info[loc_field]
+            property_info[loc_field] = {
+                'id': loc_data.get('id', ''),
+                'fullName': loc_data.get('fullName', ''),
+                '__typename': loc_data.get('__typename', '')
+            }
+
+    # Process 'relevantAmenities'
+    if 'relevantAmenities' in property_info and property_info['relevantAmenities']:
+        amenities_list = []
+        for amenity in property_info['relevantAmenities']:
+            amenities_list.append({
+                'kind': amenity.get('kind', ''),
+                'isRelevant': amenity.get('isRelevant', False),
+                'isAvailable': amenity.get('isAvailable', False)
+            })
+        property_info['relevantAmenities'] = amenities_list
+
+    # Process 'housingForm' and 'tenure'
+    if 'housingForm' in property_info and property_info['housingForm']:
+        housing_form = property_info['housingForm']
+        property_info['housingForm'] = {
+            'name': housing_form.get('name', ''),
+            'symbol': housing_form.get('symbol', ''),
+            'primaryGroup': housing_form.get('primaryGroup', '')
+        }
+
+    if 'tenure' in property_info and property_info['tenure']:
+        tenure = property_info['tenure']
+        property_info['tenure'] = {
+            'name': tenure.get('name', ''),
+            'symbol': tenure.get('symbol', '')
+        }
+
+    # Process 'askingPrice', 'sellingPrice', 'priceChange', 'runningCosts'
+    money_fields = ['askingPrice', 'sellingPrice', 'priceChange', 'runningCosts']
+    for field in money_fields:
+        if field in property_info and property_info[field]:
+            money_data = property_info[field]
+            property_info[field] = {
+                'formatted': money_data.get('formatted', ''),
+                'amount': money_data.get('amount', None),
+                'amountInCents': money_data.get('amountInCents', None)
+            }
+
+    # Convert 'soldAt' timestamp to readable date
+    if 'soldAt' in property_info and property_info['soldAt']:
+        try:
+            sold_at_timestamp = float(property_info['soldAt'])
+            from datetime import datetime
+            sold_at_date = datetime.fromtimestamp(sold_at_timestamp)
+            property_info['soldAt'] = sold_at_date.strftime('%Y-%m-%d')
+        except ValueError:
+            pass  # Keep the original value if conversion fails
+
+    # Include fields that may be NULL in this instance
+    possible_fields = [
+        'fee', 'formattedFloor', 'squareMeterSellingPrice',
+        'yearlyArrendeFee', 'yearlyLeaseholdFee', 'housingCooperative'
+    ]
+    for field in possible_fields:
+        if field not in property_info:
+            property_info[field] = None  # Set to None if not present
+
+    return property_info
+
+
+def bench(label, func, payloads, repeat):
+    seconds = min(timeit.repeat(lambda: [func(payload) for payload in payloads], number=1, repeat=repeat))
+    per_payload = seconds / len(payloads) * 1e6
+    print(f"{label:<32} {seconds:8.3f}s  {per_payload:8.1f}us/payload")
+    return seconds
+
+
+def main(directory, repeat):
+    files = sorted(glob.glob(os.path.join(directory, '*.json')))
+    if not files:
+        raise SystemExit(f"No *.json payloads found in {directory}")
+    payloads = []
+    for filename in files:
+        with open(filename, 'rb') as f:
+            payloads.append(f.read())
+
+    # Both extractions must agree before their timings mean anything
+    for filename, payload in zip(files, payloads):
+        if parse_next_data(payload) != legacy_parse_property_info(json.loads(payload)):
+            raise SystemExit(f"Extractors disagree on {filename}")
+
+    print(f"{len(payloads)} payloads, best of {repeat} runs, decoder: {loads.__module__}")
+    baseline = bench('hand-written + json', lambda p: legacy_parse_property_info(json.loads(p)), payloads, repeat)
+    bench('compiled + json', lambda p: parse_property_info(json.loads(p)), payloads, repeat)
+    compiled = bench('compiled + fast decoder', parse_next_data, payloads, repeat)
+    print(f"Speed-up: {baseline / compiled:.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the __NEXT_DATA__ extractors.')
+    parser.add_argument('directory', help='Directory of saved __NEXT_DATA__ payloads')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.directory, args.repeat)
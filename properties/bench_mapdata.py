@@ -0,0 +1,136 @@
+# bench_mapdata.py
+#
+# Benchmark of the compiled photometa parser in mapdata.py against digging
+# through the nested arrays by hand, on saved Google Maps responses.
+#
+# Usage: python properties/bench_mapdata.py <directory of *.json responses>
+#        python properties/bench_mapdata.py --copies 5000 map_data.json
+
+import argparse
+import glob
+import json
+import os
+import random
+import tempfile
+import time
+import timeit
+
+from extract import loads
+from mapdata import iter_map_files, parse_map_data, parse_panorama
+
+
+def _dig(data, *path):
+    try:
+        for index in path:
+            data = data[index]
+        return data
+    except (IndexError, TypeError):
+        return None
+
+
+def legacy_parse_panorama(data):
+    """Digs every field out of a parsed response by hand, the baseline of the benchmark."""
+    levels = _dig(data, 1, 2, 3, 0)
+    neighbours = _dig(data, 1, 5, 0, 3, 0)
+    return {
+        'pano_id': _dig(data, 1, 1, 1),
+        'image_height': _dig(data, 1, 2, 2, 0),
+        'image_width': _dig(data, 1, 2, 2, 1),
+        'zoom_levels': len(levels) if levels is not None else None,
+        'tile_height': _dig(data, 1, 2, 3, 1, 0),
+        'tile_width': _dig(data, 1, 2, 3, 1, 1),
+        'label': _dig(data, 1, 3, 2, 0, 0),
+        'language': _dig(data, 1, 3, 2, 0, 1),
+        'copyright': _dig(data, 1, 4, 0, 0, 0, 0),
+        'latitude': _dig(data, 1, 5, 0, 1, 0, 2),
+        'longitude': _dig(data, 1, 5, 0, 1, 0, 3),
+        'elevation': _dig(data, 1, 5, 0, 1, 1, 0),
+        'heading': _dig(data, 1, 5, 0, 1, 2, 0),
+        'tilt': _dig(data, 1, 5, 0, 1, 2, 1),
+        'roll': _dig(data, 1, 5, 0, 1, 2, 2),
+        'country': _dig(data, 1, 5, 0, 1, 4),
+        'capture_year': _dig(data, 1, 6, 7, 0),
+        'capture_month': _dig(data, 1, 6, 7, 1),
+        'neighbours': [
+            {
+                'pano_id': _dig(item, 0, 1),
+                'latitude': _dig(item, 2, 0, 2),
+                'longitude': _dig(item, 2, 0, 3),
+                'elevation': _dig(item, 2, 1, 0),
+                'heading': _dig(item, 2, 2, 0),
+            }
+            for item in neighbours
+        ] if neighbours is not None else None,
+    }
+
+
+def write_copies(template, directory, copies, seed=0):
+    """
+    Writes `copies` variants of a saved response to `directory`, with new
+    panorama IDs and locations jittered around the original one.
+    """
+    with open(template, 'rb') as f:
+        data = json.loads(f.read())
+    rng = random.Random(seed)
+    filenames = []
+    for i in range(copies):
+        data[1][1][1] = f'pano{i:06d}'
+        location = data[1][5][0][1][0]
+        location[2] += rng.uniform(-0.01, 0.01)
+        location[3] += rng.uniform(-0.02, 0.02)
+        filename = os.path.join(directory, f'{i:06d}.json')
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        filenames.append(filename)
+    return filenames
+
+
+def bench(label, func, payloads, repeat):
+    seconds = min(timeit.repeat(lambda: [func(payload) for payload in payloads], number=1, repeat=repeat))
+    per_payload = seconds / len(payloads) * 1e6
+    print(f"{label:<32} {seconds:8.3f}s  {per_payload:8.1f}us/response")
+    return seconds
+
+
+def main(files, repeat):
+    payloads = []
+    for filename in files:
+        with open(filename, 'rb') as f:
+            payloads.append(f.read())
+
+    # Both parsers must agree before their timings mean anything
+    for filename, payload in zip(files, payloads):
+        if parse_map_data(payload) != legacy_parse_panorama(json.loads(payload)):
+            raise SystemExit(f"Parsers disagree on {filename}")
+
+    print(f"{len(payloads)} responses, best of {repeat} runs, decoder: {loads.__module__}")
+    decoded = [json.loads(payload) for payload in payloads]
+    baseline = bench('hand-written, decoded', legacy_parse_panorama, decoded, repeat)
+    compiled = bench('compiled, decoded', parse_panorama, decoded, repeat)
+    print(f"Speed-up of the extraction: {baseline / compiled:.2f}x")
+    baseline = bench('hand-written + json', lambda p: legacy_parse_panorama(json.loads(p)), payloads, repeat)
+    compiled = bench('compiled + fast decoder', parse_map_data, payloads, repeat)
+    print(f"Speed-up with decoding: {baseline / compiled:.2f}x")
+
+    start = time.perf_counter()
+    panoramas = sum(1 for _ in iter_map_files(files))
+    seconds = time.perf_counter() - start
+    print(f"{'streamed from disk':<32} {seconds:8.3f}s  {seconds / len(files) * 1e6:8.1f}us/response, "
+          f"{panoramas} panoramas")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the photometa response parsers.')
+    parser.add_argument('path', help='Directory of saved responses, or a response to copy with --copies')
+    parser.add_argument('--copies', type=int, default=0,
+                        help='Benchmark on this many generated variants of the response at `path`')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.copies:
+        with tempfile.TemporaryDirectory() as directory:
+            main(write_copies(args.path, directory, args.copies), args.repeat)
+    else:
+        files = sorted(glob.glob(os.path.join(args.path, '*.json')))
+        if not files:
+            raise SystemExit(f"No *.json responses found in {args.path}")
+        main(files, args.repeat)
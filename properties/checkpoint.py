@@ -0,0 +1,151 @@
+# checkpoint.py
+
+import json
+import logging
+import os
+import sys
+import threading
+
+# The modules in utils/ at the repository root are shadowed by
+# properties/utils.py, so they are imported from their directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from files import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+def write_json_atomic(filename, data):
+    """
+    Writes `data` as JSON to a temporary file and renames it over `filename`,
+    so a crash never leaves a half-written file behind.
+    """
+    write_atomic(filename, json.dumps(data, ensure_ascii=False), fsync=True)
+
+
+class Checkpoint:
+    """
+    Checkpoint of a scrape run, kept in a directory with two files:
+    - records.jsonl: the scraped records, one {"link", "record"} per line
+    - state.json: the collected links, the last collected page, whether link
+      collection is complete and the size of records.jsonl at the last
+      checkpoint
+
+    Records written after the last checkpoint are discarded on resume.
+    """
+
+    def __init__(self, directory, location_ids, every=25):
+        self.directory = directory
+        self.location_ids = location_ids
+        self.every = every
+        self.state_file = os.path.join(directory, 'state.json')
+        self.records_file = os.path.join(directory, 'records.jsonl')
+        self.pages_done = 0
+        self.links_complete = False
+        self.links = []
+        self.done = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._records = None
+
+    def start(self, resume=False):
+        """
+        Opens the checkpoint, loading the previous run's state if `resume`
+        is set and discarding it otherwise.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        records_offset = 0
+        if resume and os.path.exists(self.state_file):
+            with open(self.state_file, encoding='utf-8') as f:
+                state = json.load(f)
+            if state['location_ids'] != self.location_ids:
+                raise ValueError(
+                    f"Checkpoint is for location_ids {state['location_ids']}, not {self.location_ids}"
+                )
+            self.pages_done = state['pages_done']
+            self.links = state['links']
+            self.links_complete = state['links_complete']
+            records_offset = state['records_offset']
+            logger.info(
+                f"Resuming after page {self.pages_done} with {len(self.links)} links collected"
+            )
+
+        # Drop records written after the last checkpoint
+        with open(self.records_file, 'ab') as f:
+            f.truncate(records_offset)
+        for line in self.iter_lines():
+            self.done.add(line['link'])
+        if resume:
+            logger.info(f"{len(self.done)} properties already scraped")
+
+        self._records = open(self.records_file, 'ab')
+        self.save()
+
+    def iter_lines(self):
+        with open(self.records_file, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def add_links(self, page, links):
+        """Records the links collected from a result page."""
+        with self._lock:
+            self.links.extend(links)
+            self.pages_done = page
+            self._save()
+
+    def complete_links(self):
+        """Records that all links have been collected."""
+        with self._lock:
+            self.links_complete = True
+            self._save()
+
+    def add_record(self, link, record):
+        """Appends a scraped record, checkpointing every `every` records."""
+        with self._lock:
+            line = json.dumps({'link': link, 'record': record}, ensure_ascii=False) + '\n'
+            self._records.write(line.encode('utf-8'))
+            self.done.add(link)
+            self._pending += 1
+            if self._pending >= self.every:
+                self._save()
+
+    def pending_links(self):
+        """Returns the collected links that have not been scraped yet."""
+        return [link for link in self.links if link not in self.done]
+
+    def iter_records(self):
+        """
+        Yields the scraped records in link order, reading them one at a time
+        so they never all sit in memory.
+        """
+        self.save()
+        offsets = {}
+        with open(self.records_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                offsets[json.loads(line)['link']] = offset
+                offset += len(line)
+            for link in self.links:
+                if link in offsets:
+                    f.seek(offsets.pop(link))
+                    yield json.loads(f.readline())['record']
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._records.flush()
+        os.fsync(self._records.fileno())
+        write_json_atomic(self.state_file, {
+            'location_ids': self.location_ids,
+            'pages_done': self.pages_done,
+            'links': self.links,
+            'links_complete': self.links_complete,
+            'records_offset': self._records.tell(),
+        })
+        self._pending = 0
+
+    def close(self):
+        if self._records is not None and not self._records.closed:
+            self.save()
+            self._records.close()
@@ -0,0 +1,172 @@
+# coordinates.py
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from seleniumwire.utils import decode
+
+from checkpoint import write_json_atomic
+from fetch import rebase_url
+
+logger = logging.getLogger(__name__)
+
+# Headers of the captured saleMap request that must not be replayed as is,
+# or written to the cache file: the session cookie and credentials stay out
+SKIPPED_HEADERS = {'content-length', 'host', 'connection', 'cookie', 'authorization', 'proxy-authorization'}
+
+
+def decompress_body(body, content_encoding=None):
+    """
+    Returns the bytes of a captured response body, decoded from its
+    Content-Encoding, e.g. gzip, deflate or br. Raises ValueError if the body
+    cannot be decoded.
+    """
+    return decode(body, content_encoding or 'identity')
+
+
+def sales_coordinates(data):
+    """
+    Returns the coordinates of every sale in a saleMap GraphQL response as a
+    dictionary of listing ID -> (lat, long). The map of a listing also shows
+    the sales around it, so one response covers many listings.
+    """
+    coordinates = {}
+    for sale in (data.get('data') or {}).get('sales') or []:
+        point = sale.get('coordinates') or {}
+        if sale.get('id') is not None and point.get('lat') is not None:
+            coordinates[str(sale['id'])] = (point['lat'], point['long'])
+    return coordinates
+
+
+def replayable_headers(headers):
+    """Returns the headers of a captured request without the ones in SKIPPED_HEADERS."""
+    return {key: value for key, value in headers.items() if key.lower() not in SKIPPED_HEADERS}
+
+
+def capture_template(request, listing_id):
+    """
+    Keeps what is needed to replay a captured saleMap request for another
+    listing.
+    """
+    return {
+        'url': request.url,
+        'headers': replayable_headers(request.headers),
+        'body': request.body.decode('utf-8'),
+        'listing_id': listing_id,
+    }
+
+
+class CoordinateCache:
+    """
+    Coordinates of sold listings keyed by listing ID, kept in a JSON file so
+    they are never fetched twice. Also keeps a saleMap request template for
+    replaying map queries.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.coordinates = {}
+        self.template = None
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                data = json.load(f)
+            self.coordinates = {key: tuple(value) for key, value in data['coordinates'].items()}
+            self.template = data.get('template')
+            # Files written before the cookies were left out
+            if self.template is not None:
+                self.template['headers'] = replayable_headers(self.template.get('headers') or {})
+
+    def __contains__(self, listing_id):
+        return listing_id in self.coordinates
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def get(self, listing_id):
+        """Returns the (lat, long) of a listing, or (None, None)."""
+        return self.coordinates.get(listing_id, (None, None))
+
+    def update(self, coordinates):
+        with self._lock:
+            self.coordinates.update(coordinates)
+
+    def set_template(self, template):
+        with self._lock:
+            if self.template is None:
+                self.template = template
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with self._lock:
+            write_json_atomic(self.filename, {
+                'template': self.template,
+                'coordinates': {key: list(value) for key, value in self.coordinates.items()},
+            })
+
+
+def replay_sale_map(session, template, listing_id, timeout=30, limiter=None, archive=None):
+    """
+    Replays the captured saleMap request for another listing by swapping the
+    listing ID in its body, keeping the response in `archive` if one is
+    given. Returns the coordinates of the sales in the response.
+    """
+    body = template['body'].replace(template['listing_id'], listing_id)
+    if limiter is not None:
+        limiter.acquire()
+    response = session.post(rebase_url(template['url']), data=body.encode('utf-8'),
+                            headers=template['headers'], timeout=timeout)
+    if limiter is not None:
+        limiter.observe(response.status_code, response.headers)
+    response.raise_for_status()
+    if archive is not None:
+        archive.put(listing_id, 'sale_map', response.content, template['url'])
+    return sales_coordinates(response.json())
+
+
+def fetch_missing_coordinates(listing_ids, cache, concurrency=4, limiter=None, archive=None):
+    """
+    Replays saleMap queries for the listings the cache does not cover,
+    within the request budget of `limiter` if one is given.
+    Every response adds the sales around the listing to the cache, so
+    listings are resolved in batches rather than one page load each.
+    """
+    template = cache.template
+    if template is not None and template['listing_id'] not in template['body']:
+        logger.warning("The saleMap template does not contain its listing ID, cannot replay it")
+        template = None
+
+    if template is None:
+        return
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(listing_ids), concurrency):
+            batch = [listing_id for listing_id in listing_ids[start:start + concurrency] if listing_id not in cache]
+            if batch:
+                results = executor.map(
+                    lambda listing_id: _replay(session, template, listing_id, limiter, archive), batch
+                )
+                for coordinates in results:
+                    cache.update(coordinates)
+
+
+def fill_coordinates(record, cache):
+    """
+    Fills in the latitude/longitude of a record from the cache if it has
+    none. Returns whether the record has coordinates.
+    """
+    if record.get('latitude') is None and record.get('id') is not None:
+        record['latitude'], record['longitude'] = cache.get(record['id'])
+    return record.get('latitude') is not None
+
+
+def _replay(session, template, listing_id, limiter=None, archive=None):
+    try:
+        return replay_sale_map(session, template, listing_id, limiter=limiter, archive=archive)
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"saleMap replay failed for listing {listing_id}: {e}")
+        return {}
@@ -0,0 +1,272 @@
+# driver_factory.py
+
+import collections
+import glob
+import json
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from selenium.common.exceptions import SessionNotCreatedException
+from webdriver_manager.chrome import ChromeDriverManager
+
+logger = logging.getLogger(__name__)
+
+DRIVER_DIR = 'properties/.driver'
+CHROMEDRIVER_CACHE = os.path.join(DRIVER_DIR, 'chromedriver.json')
+PROFILE_TEMPLATE = os.path.join(DRIVER_DIR, 'profile')
+
+# The cached chromedriver is resolved again after a week, to follow Chrome updates
+CHROMEDRIVER_MAX_AGE = 7 * 24 * 3600
+
+# Chrome switches that skip the work a fresh browser does on its first start
+WARM_START_ARGUMENTS = (
+    '--no-first-run',
+    '--no-default-browser-check',
+    '--disable-background-networking',
+    '--disable-component-update',
+    '--disable-sync',
+)
+
+# Files of a profile that belong to the browser holding it
+PROFILE_LOCKS = ('SingletonLock', 'SingletonSocket', 'SingletonCookie', 'lockfile')
+
+_resolved = {}
+_resolve_lock = threading.Lock()
+
+
+def _read_cache(cache_file, max_age):
+    try:
+        with open(cache_file, encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    path = cached.get('path')
+    if not path or not os.access(path, os.X_OK) or time.time() - cached.get('resolved', 0) > max_age:
+        return None
+    return path
+
+
+def chromedriver_path(cache_file=CHROMEDRIVER_CACHE, max_age=CHROMEDRIVER_MAX_AGE):
+    """
+    Returns the path of the chromedriver binary. It is resolved with
+    ChromeDriverManager once, then kept in `cache_file` for `max_age` seconds
+    and in memory for the rest of the process. The CHROMEDRIVER environment
+    variable overrides it.
+    """
+    if os.environ.get('CHROMEDRIVER'):
+        return os.environ['CHROMEDRIVER']
+    with _resolve_lock:
+        if cache_file not in _resolved:
+            path = _read_cache(cache_file, max_age)
+            if path is None:
+                start = time.perf_counter()
+                path = ChromeDriverManager().install()
+                logger.info(f"Resolved chromedriver at {path} in {time.perf_counter() - start:.1f}s")
+                os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+                with open(cache_file + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump({'path': path, 'resolved': time.time()}, f)
+                os.replace(cache_file + '.tmp', cache_file)
+            _resolved[cache_file] = path
+        return _resolved[cache_file]
+
+
+def forget_chromedriver(cache_file=CHROMEDRIVER_CACHE):
+    """Drops the cached chromedriver path, e.g. when it no longer matches Chrome."""
+    with _resolve_lock:
+        _resolved.pop(cache_file, None)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+
+def clone_profile(template_dir):
+    """Returns a new temporary profile directory with a copy of `template_dir`."""
+    profile_dir = tempfile.mkdtemp(prefix='chrome-profile-')
+    shutil.copytree(template_dir, profile_dir, dirs_exist_ok=True, symlinks=True,
+                    ignore=shutil.ignore_patterns(*PROFILE_LOCKS))
+    return profile_dir
+
+
+def process_tree(pid):
+    """
+    Returns a process and its descendants, found through the children lists
+    in /proc, or just the process where they are not available.
+    """
+    pids = [pid]
+    for current in pids:
+        for children in glob.glob(f'/proc/{current}/task/*/children'):
+            try:
+                with open(children) as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except (OSError, ValueError):
+                continue
+    return pids
+
+
+def kill_process_tree(pid):
+    """Kills a process and its descendants, the children first."""
+    for current in reversed(process_tree(pid)):
+        try:
+            os.kill(current, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        except OSError:
+            pass
+
+
+class DriverFactory:
+    """
+    Starts drivers with `setup(driver_path=..., profile_dir=..., **options)`,
+    with the cached chromedriver path and a copy of a prepared profile:
+    `profile_template` is filled by starting a browser on it once, and every
+    driver gets its own copy of it, as a profile can only be used by one
+    browser at a time.
+
+    With `prewarm`, a background thread keeps that many drivers started ahead
+    of time, so `get` hands one out at once, or waits for one already being
+    started rather than starting another. Cold and warm waits for a driver
+    are recorded in the `metrics` option if given, and summarized by `close`.
+    """
+
+    def __init__(self, setup, prewarm=0, profile_template=PROFILE_TEMPLATE, **options):
+        self.setup = setup
+        self.prewarm = prewarm
+        self.profile_template = profile_template
+        self.options = options
+        self.metrics = options.get('metrics')
+        self.waits = {'cold': [], 'warm': []}
+        # Drivers started ahead, warm starts under way and get calls waiting for them
+        self._ready = collections.deque()
+        self._starting = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._profile_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._wanted = threading.Semaphore(prewarm)
+        self._warmer = None
+        if prewarm:
+            self._warmer = threading.Thread(target=self._warm, daemon=True)
+            self._warmer.start()
+
+    def _prepare_profile(self):
+        with self._profile_lock:
+            if os.path.isdir(self.profile_template):
+                return
+            start = time.perf_counter()
+            preparing = self.profile_template + '.tmp'
+            shutil.rmtree(preparing, ignore_errors=True)
+            os.makedirs(preparing)
+            driver = self.setup(driver_path=chromedriver_path(), profile_dir=preparing, **self.options)
+            driver.quit()
+            os.replace(preparing, self.profile_template)
+            logger.info(f"Prepared the browser profile in {time.perf_counter() - start:.1f}s")
+
+    def start(self):
+        """Starts a new driver."""
+        self._prepare_profile()
+        profile_dir = clone_profile(self.profile_template)
+        try:
+            try:
+                driver = self.setup(driver_path=chromedriver_path(), profile_dir=profile_dir, **self.options)
+            except SessionNotCreatedException:
+                # Chrome was updated past the cached chromedriver
+                logger.warning("chromedriver does not match Chrome, resolving it again")
+                forget_chromedriver()
+                driver = self.setup(driver_path=chromedriver_path(), profile_dir=profile_dir, **self.options)
+        except Exception:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            raise
+        driver.profile_dir = profile_dir
+        return driver
+
+    def _warm(self):
+        while True:
+            self._wanted.acquire()
+            if self._closed.is_set():
+                return
+            with self._cond:
+                self._starting += 1
+            try:
+                driver = self.start()
+            except Exception as e:
+                logger.error(f"Could not start a driver ahead of time: {e}")
+                driver = None
+            closed = self._closed.is_set()
+            with self._cond:
+                self._starting -= 1
+                if driver is not None and not closed:
+                    self._ready.append(driver)
+                self._cond.notify_all()
+            if closed:
+                if driver is not None:
+                    self.release(driver)
+                return
+            if driver is None:
+                self._closed.wait(5)
+                self._wanted.release()
+
+    def get(self):
+        """
+        Returns a driver started ahead of time if one is ready, or waits for
+        one being started ahead that no other call waits for, or starts one.
+        """
+        start = time.perf_counter()
+        with self._cond:
+            if not self._ready and self._starting > self._waiting:
+                self._waiting += 1
+                self._cond.wait_for(lambda: self._ready or not self._starting)
+                self._waiting -= 1
+            driver = self._ready.popleft() if self._ready else None
+        if driver is not None:
+            kind = 'warm'
+            self._wanted.release()
+        else:
+            driver = self.start()
+            kind = 'cold'
+        seconds = time.perf_counter() - start
+        self.waits[kind].append(seconds)
+        if self.metrics is not None:
+            self.metrics.observe('driver_wait_seconds', seconds, start=kind)
+        return driver
+
+    def release(self, driver):
+        """Quits a driver and removes its profile."""
+        try:
+            driver.quit()
+        finally:
+            profile_dir = getattr(driver, 'profile_dir', None)
+            if profile_dir is not None:
+                shutil.rmtree(profile_dir, ignore_errors=True)
+
+    def kill(self, driver):
+        """
+        Kills the processes of a driver that stopped responding, so the call
+        waiting on it fails. The driver is still released as usual.
+        """
+        process = getattr(driver.service, 'process', None)
+        if process is not None:
+            kill_process_tree(process.pid)
+
+    def summary(self):
+        """Returns the number and mean seconds of the cold and warm waits for a driver."""
+        return {
+            kind: {'count': len(waits), 'mean': sum(waits) / len(waits) if waits else 0.0}
+            for kind, waits in self.waits.items()
+        }
+
+    def close(self):
+        """Stops starting drivers ahead of time and quits the ones not handed out."""
+        self._closed.set()
+        if self._warmer is not None:
+            self._wanted.release()
+            self._warmer.join()
+        with self._cond:
+            ready = list(self._ready)
+            self._ready.clear()
+        for driver in ready:
+            self.release(driver)
+        for kind, stats in self.summary().items():
+            if stats['count']:
+                logger.info(f"{stats['count']} {kind} driver starts, waited {stats['mean']:.2f}s on average")
@@ -0,0 +1,171 @@
+# extract.py
+
+import json
+import os
+import sys
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Use orjson to decode __NEXT_DATA__ payloads when it is installed
+loads = orjson.loads if orjson is not None else json.loads
+
+LISTING_PREFIX = 'SoldPropertyListing:'
+
+# Listing IDs are parsed as in the listing registry in utils/, which is
+# shadowed by properties/utils.py and so imported from its directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from registry import listing_id_from_url
+
+
+def record(**defaults):
+    """Field spec for an object, keeping `defaults`' keys with their defaults."""
+    return ('record', tuple(defaults.items()))
+
+
+def records(**defaults):
+    """Field spec for a list of objects, each projected like `record`."""
+    return ('records', tuple(defaults.items()))
+
+
+def timestamp_date():
+    """Field spec for a Unix timestamp converted to a YYYY-MM-DD date."""
+    return ('date', None)
+
+
+MONEY = record(formatted='', amount=None, amountInCents=None)
+LOCATION = record(id='', fullName='', __typename='')
+
+# Fields of the SoldPropertyListing that are reshaped after their references
+# have been resolved. The other fields are kept as they are.
+FIELD_SCHEMA = {
+    'broker': record(
+        name='', email='', phoneNumber='', description='', id='', slug='',
+        hasActiveProfile=False, canonicalUrl='',
+    ),
+    'brokerAgency': record(
+        id='', name='', phoneNumber='', email='', websiteUrl='', slug='',
+        offersSellingPrices=False, isKronofogden=False, developer=False,
+    ),
+    'districts': records(id='', fullName='', __typename=''),
+    'municipality': LOCATION,
+    'county': LOCATION,
+    'relevantAmenities': records(kind='', isRelevant=False, isAvailable=False),
+    'housingForm': record(name='', symbol='', primaryGroup=''),
+    'tenure': record(name='', symbol=''),
+    'askingPrice': MONEY,
+    'sellingPrice': MONEY,
+    'priceChange': MONEY,
+    'runningCosts': MONEY,
+    'soldAt': timestamp_date(),
+}
+
+# Image data and ad targeting are left out
+EXCLUDED_FIELDS = ('attributedImages', 'adTargeting')
+
+# Fields that may be NULL in this instance, set to None if not present
+NULLABLE_FIELDS = (
+    'fee', 'formattedFloor', 'squareMeterSellingPrice',
+    'yearlyArrendeFee', 'yearlyLeaseholdFee', 'housingCooperative',
+)
+
+
+def _compile_field(kind, items):
+    if kind == 'record':
+        return lambda value: {key: value.get(key, default) for key, default in items}
+    if kind == 'records':
+        return lambda value: [
+            {key: item.get(key, default) for key, default in items} for item in value
+        ]
+    if kind == 'date':
+        def convert_date(value):
+            try:
+                return datetime.fromtimestamp(float(value)).strftime('%Y-%m-%d')
+            except (TypeError, ValueError):
+                return value  # Keep the original value if conversion fails
+        return convert_date
+    raise ValueError(f"Unknown field spec: {kind}")
+
+
+def compile_extractor(schema=FIELD_SCHEMA, excluded=EXCLUDED_FIELDS, nullable=NULLABLE_FIELDS):
+    """
+    Compiles a field schema into a function that turns a listing from the
+    Apollo state into a property information dictionary in a single pass.
+    """
+    converters = {field: _compile_field(*spec) for field, spec in schema.items()}
+    excluded = frozenset(excluded)
+
+    def extract(apollo_state, listing):
+        get_ref = apollo_state.get
+        property_info = {}
+        for key, value in listing.items():
+            if key in excluded:
+                continue
+            # Resolve references to other objects in the Apollo state
+            if type(value) is dict:
+                if '__ref' in value:
+                    value = get_ref(value['__ref'], {})
+            elif type(value) is list:
+                value = [
+                    get_ref(item['__ref'], {}) if type(item) is dict and '__ref' in item else item
+                    for item in value
+                ]
+            if value:
+                convert = converters.get(key)
+                if convert is not None:
+                    value = convert(value)
+            property_info[key] = value
+        for field in nullable:
+            if field not in property_info:
+                property_info[field] = None
+        return property_info
+
+    return extract
+
+
+extract_listing = compile_extractor()
+
+
+def find_listing(apollo_state, listing_id=None):
+    """
+    Returns the SoldPropertyListing object of the Apollo state, looked up by
+    `listing_id` when it is known. Returns None if there is none.
+    """
+    if listing_id is not None:
+        listing = apollo_state.get(LISTING_PREFIX + str(listing_id))
+        if listing is not None:
+            return listing
+    for key in apollo_state:
+        if key.startswith(LISTING_PREFIX):
+            return apollo_state[key]
+    return None
+
+
+def parse_property_info(data, listing_id=None):
+    """
+    Extracts the property information from a parsed __NEXT_DATA__ payload.
+    Returns a dictionary with the data, or an empty dictionary.
+    """
+    try:
+        apollo_state = data['props']['pageProps']['__APOLLO_STATE__']
+    except (KeyError, TypeError):
+        return {}
+    listing = find_listing(apollo_state, listing_id)
+    if listing is None:
+        return {}
+    return extract_listing(apollo_state, listing)
+
+
+def parse_next_data(content, listing_id=None):
+    """
+    Decodes a raw __NEXT_DATA__ payload and extracts the property information.
+    Returns a dictionary with the data, or an empty dictionary.
+    """
+    try:
+        data = loads(content)
+    except ValueError:
+        return {}
+    return parse_property_info(data, listing_id)
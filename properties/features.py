@@ -0,0 +1,72 @@
+# features.py
+
+import argparse
+import logging
+import os
+import sys
+
+import pandas as pd
+
+# The modules in utils/ at the repository root are shadowed by
+# properties/utils.py, so they are imported from their directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from geo import POINTS_OF_INTEREST, comparable_sales, distance_features, sales_within
+from schema import PARTITIONED_SCHEMA
+from storage import load_parquet, save_to_parquet
+
+DATASET_DIR = 'properties/dataset'
+FEATURES_FILE = 'properties/features.parquet'
+
+COLUMNS = ['id', 'soldAt', 'latitude', 'longitude', 'squareMeterSellingPrice']
+
+
+def parse_point(value):
+    """Parses a point of interest given as name=latitude,longitude."""
+    try:
+        name, coordinates = value.split('=', 1)
+        latitude, longitude = (float(part) for part in coordinates.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected name=latitude,longitude, got {value!r}")
+    return name, (latitude, longitude)
+
+
+def build_features(dataset_dir=DATASET_DIR, output_file=FEATURES_FILE, points=None, k=10,
+                   radius_km=2.0, filters=None):
+    """
+    Computes location features of the sold listings in the dataset: the
+    distance to each point of interest, the k nearest comparable sales sold
+    before each listing within `radius_km`, and the number of earlier sales
+    within `radius_km`. Writes them keyed by listing id and returns them.
+    """
+    df = load_parquet(dataset_dir, columns=COLUMNS, filters=filters, schema=PARTITIONED_SCHEMA)
+    df = df.drop_duplicates('id', keep='last').reset_index(drop=True)
+    located = df['latitude'].notna() & df['longitude'].notna()
+    logging.info(f"Computing features of {len(df)} listings, {located.sum()} with coordinates")
+
+    features = pd.concat([
+        df[['id']],
+        distance_features(df, points),
+        comparable_sales(df, k, radius_km),
+        sales_within(df, radius_km),
+    ], axis=1)
+    save_to_parquet(features, output_file)
+    logging.info(f"Features saved to {output_file}")
+    return features
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Compute location features of the sold listings.')
+    parser.add_argument('--dataset', default=DATASET_DIR, help=f'Dataset to read (default: {DATASET_DIR})')
+    parser.add_argument('--output', default=FEATURES_FILE, help=f'Parquet file to write (default: {FEATURES_FILE})')
+    parser.add_argument('--point', type=parse_point, action='append', default=[],
+                        help='Extra point of interest as name=latitude,longitude, can be repeated '
+                             f'(always included: {", ".join(POINTS_OF_INTEREST)})')
+    parser.add_argument('-k', type=int, default=10, help='Number of comparable sales per listing')
+    parser.add_argument('--radius', type=float, default=2.0,
+                        help='Radius in km of comparable sales and sale counts')
+    parser.add_argument('--municipality', help='Only the listings of this municipality')
+    args = parser.parse_args()
+    filters = [('municipality', '=', args.municipality)] if args.municipality else None
+    build_features(args.dataset, args.output, {**POINTS_OF_INTEREST, **dict(args.point)}, args.k,
+                   args.radius, filters)
@@ -0,0 +1,174 @@
+# fetch.py
+
+import asyncio
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from extract import listing_id_from_url
+
+logger = logging.getLogger(__name__)
+
+HEMNET_URL = 'https://www.hemnet.se'
+
+# Point the scrapers at a local stand-in with HEMNET_BASE_URL=http://127.0.0.1:8000
+BASE_URL = os.environ.get('HEMNET_BASE_URL', HEMNET_URL).rstrip('/')
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml',
+    'Accept-Language': 'sv-SE,sv;q=0.9,en;q=0.8',
+}
+
+# The __NEXT_DATA__ tag is server rendered, so a regex over the raw HTML is
+# enough to find it; there is no need to build a DOM for the whole page.
+NEXT_DATA_PATTERN = re.compile(
+    r'<script[^>]*\bid="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL
+)
+
+
+def rebase_url(url):
+    """Maps a hemnet.se URL onto BASE_URL."""
+    if url.startswith(HEMNET_URL):
+        return BASE_URL + url[len(HEMNET_URL):]
+    return url
+
+
+def find_next_data(html):
+    """
+    Finds the JSON payload of the __NEXT_DATA__ <script> tag in raw HTML.
+    Returns the payload as a string, or None if the tag is missing.
+    """
+    match = NEXT_DATA_PATTERN.search(html)
+    return match.group(1) if match else None
+
+
+def create_session(concurrency):
+    """
+    Creates a requests session whose connection pool holds one connection
+    per concurrent fetch.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, max_retries=2)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _get(session, url, timeout, limiter=None, metrics=None):
+    if limiter is not None:
+        limiter.acquire()
+    if metrics is None:
+        return session.get(rebase_url(url), timeout=timeout)
+    with metrics.time('http_fetch'):
+        response = session.get(rebase_url(url), timeout=timeout)
+    metrics.inc('bytes', len(response.content), source='http')
+    # Attempts the adapter retried before this response
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        metrics.inc('retries', len(retries.history), source='http')
+    return response
+
+
+def _count(metrics, result):
+    if metrics is not None:
+        metrics.inc('http_fetches', result=result)
+
+
+async def fetch_property(session, executor, semaphore, url, timeout=30, fixture_store=None,
+                         limiter=None, metrics=None):
+    """
+    Downloads a property page and returns its raw __NEXT_DATA__ payload for
+    the parse stage of the pipeline, or None if the page has to be scraped
+    with the browser instead. The blocking request runs on `executor`, the
+    coroutine only waits for it. Fetch times, bytes and outcomes are
+    recorded in `metrics` if given.
+    """
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        try:
+            response = await loop.run_in_executor(
+                executor, _get, session, url, timeout, limiter, metrics
+            )
+        except requests.RequestException as e:
+            logger.warning(f"HTTP fetch failed for {url}: {e}")
+            _count(metrics, 'error')
+            return None
+
+    if fixture_store is not None:
+        fixture_store.save('GET', url, b'', response.status_code, response.headers, response.content)
+
+    next_data = find_next_data(response.text) if response.status_code == 200 else None
+    if limiter is not None:
+        # A page without __NEXT_DATA__ may be a captcha
+        limiter.observe(response.status_code, response.headers,
+                        response.content if response.status_code == 200 and next_data is None else None)
+
+    if response.status_code != 200:
+        logger.warning(f"HTTP fetch of {url} returned status {response.status_code}")
+        _count(metrics, f'status_{response.status_code}')
+        return None
+
+    if next_data is None:
+        logger.warning(f"No __NEXT_DATA__ found in {url}")
+        _count(metrics, 'no_next_data')
+        return None
+
+    _count(metrics, 'success')
+    return {'link': url, 'listing_id': listing_id_from_url(url), 'url': url, 'next_data': next_data}
+
+
+class PropertyFetcher:
+    """
+    Fetches property pages over plain HTTP for one run. The fetches are
+    blocking requests calls run on a pool of `concurrency` threads; asyncio
+    only schedules them and caps the requests in flight. The session, the
+    thread pool and the event loop are created once and reused by every
+    `fetch` until `close`.
+
+    The responses are recorded in `fixture_store` if one is given, each
+    request takes a token from `limiter` and the fetches are measured in
+    `metrics` if they are given.
+    """
+
+    def __init__(self, concurrency=20, fixture_store=None, limiter=None, metrics=None):
+        self.concurrency = concurrency
+        self.fixture_store = fixture_store
+        self.limiter = limiter
+        self.metrics = metrics
+        self.session = create_session(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def _fetch(self, urls):
+        return await asyncio.gather(
+            *(fetch_property(self.session, self.executor, self.semaphore, url,
+                             fixture_store=self.fixture_store, limiter=self.limiter, metrics=self.metrics)
+              for url in urls)
+        )
+
+    def fetch(self, urls):
+        """
+        Fetches property pages with at most `concurrency` requests in flight.
+        Returns a list aligned with `urls` holding the raw payloads, or None
+        for pages that need to be scraped with the browser.
+        """
+        return self.loop.run_until_complete(self._fetch(urls))
+
+    def close(self):
+        self.loop.close()
+        self.executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,45 @@
+# links.py
+
+import logging
+
+from utils import get_property_links
+from extract import listing_id_from_url
+
+logger = logging.getLogger(__name__)
+
+
+def collect_links(pool, location_ids, total_pages, start_page=1, known_ids=None, on_page=None):
+    """
+    Collects the property links of result pages `start_page` to `total_pages`,
+    loading as many pages at once as the pool has drivers.
+
+    With `known_ids`, collection stops at the first page whose listings are
+    all known: sold listings are sorted newest first, so the pages after it
+    hold no new sales. `on_page(page, links)` is called for every page in
+    order. A page that does not load is tried once more, then collection
+    stops before it, so a resumed run starts from it.
+    Returns the links in page order, and whether collection got through.
+    """
+    if pool.workers < 1:
+        raise ValueError(f"Collecting links needs at least one worker, the pool has {pool.workers}")
+    fetch = lambda driver, page: get_property_links(driver, location_ids, page)
+    links = []
+    for window_start in range(start_page, total_pages + 1, pool.workers):
+        pages = list(range(window_start, min(window_start + pool.workers, total_pages + 1)))
+        results = pool.map(fetch, pages)
+        for page, page_links in zip(pages, results):
+            if page_links is None:
+                page_links = pool.map(fetch, [page])[0]
+            if page_links is None:
+                logger.error(f"Page {page} of {total_pages} did not load, stopping before it")
+                return links, False
+            logger.info(f"Found {len(page_links)} property links on page {page} of {total_pages}")
+            if known_ids is not None and page_links and all(
+                listing_id_from_url(link) in known_ids for link in page_links
+            ):
+                logger.info(f"Page {page} only has known listings, stopping")
+                return links, True
+            links.extend(page_links)
+            if on_page is not None:
+                on_page(page, page_links)
+    return links, True
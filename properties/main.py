@@ -1,59 +1,324 @@
 # main.py
 
-import pandas as pd
-from utils import setup_driver, extract_coordinates, extract_property_info_from_json, get_property_links, get_total_pages
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from utils import BLOCKING_PROFILES, fetch_property_payload
+from pool import DriverPool
+from pipeline import Pipeline
+from scheduler import Location, collect_location_links, fetch_locations, link_owners, scrape_locations
+from readiness import summarize_wait_timings
+from checkpoint import Checkpoint
+from coordinates import CoordinateCache, fetch_missing_coordinates, fill_coordinates
 from selenium.common.exceptions import TimeoutException
+import argparse
+import functools
 import logging
+import os
+import shutil
 import sys
-import time
 
-def main(location_ids):
+# The modules in utils/ at the repository root are shadowed by
+# properties/utils.py, so they are imported from their directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from fixtures import FixtureStore
+from ratelimit import RateLimiter
+from archive import PageArchive
+from metrics import Metrics, SamplingProfiler, process_rss, process_tree_rss
+from schema import (SOLD_LISTING_SCHEMA, PARTITIONED_SCHEMA, PARTITION_COLUMNS, listing_row,
+                    unflatten_row, with_sold_month)
+from storage import ParquetSink, load_parquet, write_dataset
+
+CHECKPOINT_DIR = 'properties/checkpoint'
+COORDINATES_FILE = 'properties/coordinates.json'
+OUTPUT_FILE = 'properties/properties.parquet'
+DATASET_DIR = 'properties/dataset'
+ARCHIVE_DIR = 'properties/archive'
+METRICS_FILE = 'properties/metrics.json'
+PROMETHEUS_FILE = 'properties/metrics.prom'
+PROFILE_FILE = 'properties/profile.txt'
+
+# Requests per second the run starts at and ramps up to by backend. Plain
+# HTTP fetches keep many requests in flight, so their budget is higher and
+# allows a burst of --concurrency requests
+DEFAULT_RATES = {'browser': (2.0, 2.0), 'http': (10.0, 40.0)}
+
+def load_known_ids(filename):
+    """
+    Returns the listing IDs in a previous output file, or an empty set.
+    """
+    if not os.path.exists(filename):
+        return set()
+    return set(load_parquet(filename, columns=['id'])['id'].astype(str))
+
+def migrate_output(filename, batch_size=1000):
+    """
+    Rewrites an output file of an earlier version, flattened with
+    json_normalize, in SOLD_LISTING_SCHEMA so new sales can be added to it.
+    The old file is kept next to it with a .bak suffix. Returns whether it
+    was migrated.
+    """
+    if not os.path.exists(filename):
+        return False
+    previous = pq.ParquetFile(filename)
+    if previous.schema_arrow.equals(SOLD_LISTING_SCHEMA):
+        return False
+    shutil.copy2(filename, filename + '.bak')
+    with ParquetSink(filename, SOLD_LISTING_SCHEMA, batch_size) as sink:
+        for batch in previous.iter_batches(batch_size=batch_size):
+            for row in batch.to_pylist():
+                sink.write(listing_row(unflatten_row(row)))
+    logging.info(f"Migrated {sink.rows} rows of {filename} to the current schema, "
+                 f"the old file is kept as {filename}.bak")
+    return True
+
+def iter_records(locations):
+    """
+    Yields the scraped records of all locations, skipping listings already
+    yielded for another location.
+    """
+    seen = set()
+    for location in locations:
+        for record in location.checkpoint.iter_records():
+            if record.get('id') is not None:
+                if record['id'] in seen:
+                    continue
+                seen.add(record['id'])
+            yield record
+
+def main(location_ids, backend='browser', concurrency=20, workers=1, resume=False,
+         checkpoint_every=25, incremental=False, record_dir=None, batch_size=1000, rate=None,
+         max_rate=None, processes=None, queue_size=100, prewarm=1, block='assets', max_pages=500,
+         max_rss_mb=1500, task_timeout=180):
     # Setup logging
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     logger = logging.getLogger()
 
-    driver = setup_driver()
+    # Each location keeps its own checkpoint, all of them share the pool
+    # and the request budget
+    locations = []
+    for location_id in location_ids:
+        checkpoint = Checkpoint(os.path.join(CHECKPOINT_DIR, location_id), location_id,
+                                every=checkpoint_every)
+        checkpoint.start(resume=resume)
+        locations.append(Location(location_id, checkpoint))
+    if rate is None:
+        rate, default_max_rate = DEFAULT_RATES[backend]
+        max_rate = max_rate or default_max_rate
+    burst = max(concurrency, workers) if backend == 'http' else max(workers, 1)
+    limiter = RateLimiter(rate, burst=burst, max_rate=max_rate)
+
+    # Stage timings and counters, exported while the run goes on
+    metrics = Metrics()
+    def collect_limiter(metrics):
+        stats = limiter.metrics()
+        metrics.set('request_rate', stats['rate'])
+        metrics.set('limiter_throttled', stats['throttled'])
+        metrics.set('limiter_requests', stats['requests'])
+    metrics.add_collector(collect_limiter)
+    metrics.start_exporter(PROMETHEUS_FILE)
+    coordinate_cache = CoordinateCache(COORDINATES_FILE)
+
+    # Record the responses as fixtures for the local stand-in
+    fixture_store = FixtureStore(record_dir) if record_dir else None
+
+    # Keep the raw payloads so the output can be rebuilt with reparse.py
+    archive = PageArchive(ARCHIVE_DIR)
+
+    known_ids = None
+    if incremental:
+        # Checked before scraping, the run's output is added to this file
+        migrate_output(OUTPUT_FILE, batch_size)
+        known_ids = load_known_ids(OUTPUT_FILE)
+        logger.info(f"{len(known_ids)} listings already in {OUTPUT_FILE}")
+
+    # The writer stage of the pipeline: keeps the coordinates and payloads
+    # of each parsed page and adds its record to the checkpoint
+    owners = {}
+    def write(payload, result):
+        property_info, coordinates, sale_map, parse_seconds = result
+        metrics.observe('stage_seconds', parse_seconds, stage='parse')
+        coordinate_cache.update(coordinates)
+        # Only a request whose response decoded is kept for replaying
+        if payload.get('template') is not None and sale_map is not None:
+            coordinate_cache.set_template(payload['template'])
+        if payload['listing_id'] is not None:
+            if payload['next_data'] is not None:
+                archive.put(payload['listing_id'], 'next_data', payload['next_data'], payload['url'])
+            if sale_map is not None:
+                archive.put(payload['listing_id'], 'sale_map', sale_map, payload.get('sale_map_url'))
+        if payload.get('sale_map') is not None and sale_map is None:
+            metrics.inc('sale_map_decode_failures')
+        if property_info:
+            owners[payload['link']].add_record(payload['link'], property_info)
+        metrics.inc('records', result='success' if property_info else 'failure')
+
+    try:
+        # Pages are fetched by the drivers or over HTTP, parsed on a process
+        # pool and written by the pipeline's writer thread
+        with Pipeline(write, processes=processes, queue_size=queue_size) as pipeline, \
+                DriverPool(workers, limiter=limiter, metrics=metrics, prewarm=prewarm,
+                           max_pages=max_pages, max_rss=max_rss_mb * 1024 * 1024 if max_rss_mb else None,
+                           memory=lambda driver: process_tree_rss(driver.service.process.pid),
+                           task_timeout=task_timeout, fixture_store=fixture_store, archive=archive,
+                           block=block) as pool:
+            metrics.add_collector(lambda metrics: metrics.set('pipeline_queue', pipeline.payloads.qsize()))
+            def collect_driver_memory(metrics):
+                for worker_id, driver in list(pool.drivers.items()):
+                    # The driver may be quitting, e.g. to be replaced
+                    process = getattr(driver.service, 'process', None)
+                    try:
+                        rss = process_tree_rss(process.pid) if process is not None else None
+                    except Exception:
+                        continue
+                    if rss is not None:
+                        metrics.set('driver_rss_bytes', rss, worker=worker_id)
+                # The Selenium Wire proxies run in this process
+                rss = process_rss(os.getpid())
+                if rss is not None:
+                    metrics.set('scraper_rss_bytes', rss)
+            metrics.add_collector(collect_driver_memory)
+
+            # Locations with the most new sales are scraped first
+            locations = collect_location_links(pool, locations, known_ids)
+            owners.update(link_owners(locations))
+            task = functools.partial(fetch_property_payload, coordinate_cache=coordinate_cache)
+
+            # Replaying saleMap queries for the coordinates needs one request
+            # captured from a property page in the browser
+            pending = [link for location in locations for link in location.pending]
+            if backend == 'http' and coordinate_cache.template is None and pending:
+                pool.map(lambda driver, link: pipeline.put(task(driver, link)), pending[:1])
+                pipeline.drain()
+
+            # Fetch the pages over plain HTTP first, the browser only handles
+            # the pages that could not be fetched that way
+            links = None
+            if backend == 'http':
+                links = fetch_locations(locations, pipeline, concurrency, fixture_store, limiter, metrics)
+                logger.info(f"{sum(map(len, links.values()))} properties left to scrape in the browser")
+
+            scrape_locations(pool, locations, task, pipeline, links)
+    finally:
+        for location in locations:
+            location.checkpoint.save()
+        coordinate_cache.save()
 
-    all_property_data = []
+    stats = limiter.metrics()
+    logger.info(
+        f"Sent {stats['requests']} requests, throttled {stats['throttled']} times, "
+        f"ending at {stats['rate'] * 60:.1f} requests a minute"
+    )
 
-    # Get total number of pages
-    total_pages = get_total_pages(driver, location_ids)
-    logger.info(f"Total pages to scrape: {total_pages}")
+    for signal, stats in summarize_wait_timings().items():
+        logger.info(
+            f"Waited for {signal} {stats['count']} times: mean {stats['mean']:.2f}s, "
+            f"max {stats['max']:.2f}s, {stats['timeouts']} timeouts"
+        )
 
-    for page in range(1, total_pages + 1):
-        logger.info(f"Scraping page {page} of {total_pages}")
-        property_links = get_property_links(driver, location_ids, page)
-        logger.info(f"Found {len(property_links)} property links on page {page}")
+    # Fetch the coordinates that were not captured while scraping
+    new_ids = set()
+    missing = []
+    for record in iter_records(locations):
+        new_ids.add(record.get('id'))
+        if not fill_coordinates(record, coordinate_cache) and record.get('id') is not None:
+            missing.append(record['id'])
+    fetch_missing_coordinates(missing, coordinate_cache, limiter=limiter, archive=archive)
+    archive.close()
+    coordinate_cache.save()
 
-        for link in property_links:
-            logger.info(f"Scraping property: {link}")
-            try:
-                driver.get(link)
-                # Wait for page to load
-                time.sleep(2)
-                property_info = extract_property_info_from_json(driver)
-                latitude, longitude = extract_coordinates(driver)
-                property_info['latitude'] = latitude
-                property_info['longitude'] = longitude
-                all_property_data.append(property_info)
-            except Exception as e:
-                logger.error(f"Error scraping property {link}: {e}")
-                continue
+    # Stream the records into the Parquet file in row groups of batch_size
+    with ParquetSink(OUTPUT_FILE, SOLD_LISTING_SCHEMA, batch_size, to_row=listing_row,
+                     metrics=metrics) as sink:
+        # Keep the sales already scraped that were not scraped again
+        if incremental and os.path.exists(OUTPUT_FILE):
+            previous = pq.ParquetFile(OUTPUT_FILE)
+            if not previous.schema_arrow.equals(SOLD_LISTING_SCHEMA):
+                raise ValueError(f"{OUTPUT_FILE} was written with another schema, cannot add to it")
+            new_id_array = pa.array(list(new_ids), pa.string())
+            for batch in previous.iter_batches(batch_size=batch_size):
+                sink.write_table(batch.filter(pc.invert(pc.is_in(batch['id'], new_id_array))))
 
-    driver.quit()
+        unresolved = 0
+        for record in iter_records(locations):
+            if not fill_coordinates(record, coordinate_cache):
+                unresolved += 1
+            sink.write(record)
+    for location in locations:
+        location.checkpoint.close()
+    logger.info(f"{unresolved} of {sink.rows} properties have no coordinates")
+    logger.info(f"Data saved to {OUTPUT_FILE}")
 
-    # Convert the list of dictionaries to a DataFrame
-    df = pd.json_normalize(all_property_data, sep='_')
+    # Lay the sales out as a dataset partitioned by municipality and month
+    # of sale, so queries only read the partitions they need
+    batches = (
+        with_sold_month(batch)
+        for batch in pq.ParquetFile(OUTPUT_FILE).iter_batches(batch_size=batch_size)
+    )
+    with metrics.time('dataset_write'):
+        write_dataset(batches, DATASET_DIR, PARTITIONED_SCHEMA, PARTITION_COLUMNS, replace=True)
+    logger.info(f"Dataset saved to {DATASET_DIR}")
 
-    # Save to Parquet file
-    df.to_parquet('properties/properties.parquet', index=False)
-    logger.info("Data saved to properties/properties.parquet")
+    metrics.stop_exporter()
+    metrics.write_prometheus(PROMETHEUS_FILE)
+    metrics.write_summary(METRICS_FILE)
+    logger.info(f"Metrics saved to {METRICS_FILE}")
 
 if __name__ == '__main__':
-    # Check if location_ids is provided as a command-line argument
-    if len(sys.argv) > 1:
-        location_ids = sys.argv[1]
-    else:
-        # Default location_ids if not provided
-        location_ids = '17860'  # Skellefteå kommun
-    main(location_ids)
+    parser = argparse.ArgumentParser(description='Scrape sold properties from Hemnet.')
+    parser.add_argument('location_ids', nargs='*', default=['17860'],
+                        help='Hemnet location ids to scrape together (default: 17860, Skellefteå kommun)')
+    parser.add_argument('--backend', choices=['browser', 'http'], default='browser',
+                        help='Fetch property pages in the browser, or over plain HTTP '
+                             'with the browser as fallback')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='Number of HTTP requests in flight with --backend http')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of browsers loading pages in parallel')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Requests per second to start at, across all locations and workers '
+                             '(default: 2 with --backend browser, 10 with --backend http)')
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help='Requests per second to ramp up to while responses are healthy '
+                             '(default: --rate, or 40 with --backend http and no --rate)')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'Resume the previous run from {CHECKPOINT_DIR}')
+    parser.add_argument('--checkpoint-every', type=int, default=25,
+                        help='Number of scraped properties between checkpoints')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'Only scrape sales newer than the ones in {OUTPUT_FILE}, '
+                             'and add them to it')
+    parser.add_argument('--block', choices=sorted(BLOCKING_PROFILES), default='assets',
+                        help='Resources kept from loading in the browser: off, assets (images, '
+                             'fonts, media, trackers) or strict (also stylesheets and map tiles)')
+    parser.add_argument('--prewarm', type=int, default=1,
+                        help='Number of browsers kept started ahead, ready to replace a worker\'s browser')
+    parser.add_argument('--max-pages', type=int, default=500,
+                        help='Number of pages after which a worker\'s browser is replaced (0: never)')
+    parser.add_argument('--max-rss-mb', type=int, default=1500,
+                        help='Memory in MB of a browser and its chromedriver past which it is replaced (0: no limit)')
+    parser.add_argument('--task-timeout', type=float, default=180,
+                        help='Seconds after which a page is given up, its browser killed and the page retried once '
+                             '(0: no limit)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of processes parsing the fetched pages (default: number of cores)')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='Number of fetched pages waiting to be parsed before the fetchers wait')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of properties per Parquet row group')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'Sample the stacks of all threads during the run into {PROFILE_FILE}')
+    parser.add_argument('--record', metavar='DIR',
+                        help='Record the fetched pages and GraphQL responses as fixtures in DIR')
+    args = parser.parse_args()
+    profiler = SamplingProfiler() if args.profile else None
+    if profiler is not None:
+        profiler.start()
+    try:
+        main(args.location_ids, args.backend, args.concurrency, args.workers, args.resume,
+             args.checkpoint_every, args.incremental, args.record, args.batch_size, args.rate,
+             args.max_rate, args.processes, args.queue_size, args.prewarm, args.block, args.max_pages,
+             args.max_rss_mb, args.task_timeout)
+    finally:
+        if profiler is not None:
+            profiler.stop(PROFILE_FILE)
@@ -0,0 +1,169 @@
+# mapdata.py
+
+import logging
+import os
+
+from extract import loads
+
+logger = logging.getLogger(__name__)
+
+# Google prefixes JSON responses with this line to stop them being run as scripts
+XSSI_PREFIX = b")]}'"
+
+
+def at(*path, type=None):
+    """Field spec for the value at `path` of positional indices, converted with `type`."""
+    return ('at', path, type)
+
+
+def each(*path, **fields):
+    """Field spec for the list at `path`, each item projected with `fields`."""
+    return ('each', path, fields)
+
+
+def count(*path):
+    """Field spec for the length of the list at `path`."""
+    return ('at', path, len)
+
+
+# Google Maps photometa responses (map_data.json) hold one panorama: its ID,
+# location, orientation, image and tile sizes, labels, capture date and the
+# panoramas linked from it, all in nested positional arrays
+PANORAMA_SPEC = {
+    'pano_id': at(1, 1, 1, type=str),
+    'image_height': at(1, 2, 2, 0, type=int),
+    'image_width': at(1, 2, 2, 1, type=int),
+    'zoom_levels': count(1, 2, 3, 0),
+    'tile_height': at(1, 2, 3, 1, 0, type=int),
+    'tile_width': at(1, 2, 3, 1, 1, type=int),
+    'label': at(1, 3, 2, 0, 0, type=str),
+    'language': at(1, 3, 2, 0, 1, type=str),
+    'copyright': at(1, 4, 0, 0, 0, 0, type=str),
+    'latitude': at(1, 5, 0, 1, 0, 2, type=float),
+    'longitude': at(1, 5, 0, 1, 0, 3, type=float),
+    'elevation': at(1, 5, 0, 1, 1, 0, type=float),
+    'heading': at(1, 5, 0, 1, 2, 0, type=float),
+    'tilt': at(1, 5, 0, 1, 2, 1, type=float),
+    'roll': at(1, 5, 0, 1, 2, 2, type=float),
+    'country': at(1, 5, 0, 1, 4, type=str),
+    'capture_year': at(1, 6, 7, 0, type=int),
+    'capture_month': at(1, 6, 7, 1, type=int),
+    'neighbours': each(
+        1, 5, 0, 3, 0,
+        pano_id=at(0, 1, type=str),
+        latitude=at(2, 0, 2, type=float),
+        longitude=at(2, 0, 3, type=float),
+        elevation=at(2, 1, 0, type=float),
+        heading=at(2, 2, 0, type=float),
+    ),
+}
+
+
+class _Node:
+    """Step of a compiled spec: the fields ending at this index and the steps below it."""
+
+    def __init__(self):
+        self.fields = []
+        self.children = {}
+        # Names of every field at or below this node
+        self.names = []
+
+
+def _generate(node, variable, depth, namespace, lines):
+    """Appends the statements reading the fields of `node` from `variable`."""
+    indent = '    ' * depth
+    for name, convert, is_list in node.fields:
+        if is_list:
+            namespace[f'_f{len(namespace)}'] = convert
+            lines.append(f"{indent}r[{name!r}] = [_f{len(namespace) - 1}(item) for item in {variable}] "
+                         f"if type({variable}) is list else None")
+        elif convert is not None:
+            namespace[f'_f{len(namespace)}'] = convert
+            lines.append(f"{indent}try:")
+            lines.append(f"{indent}    r[{name!r}] = _f{len(namespace) - 1}({variable})")
+            lines.append(f"{indent}except (TypeError, ValueError):")
+            lines.append(f"{indent}    r[{name!r}] = None")
+        else:
+            lines.append(f"{indent}r[{name!r}] = {variable}")
+    child_variable = f'v{depth + 1}'
+    for index, child in node.children.items():
+        lines.append(f"{indent}try:")
+        lines.append(f"{indent}    {child_variable} = {variable}[{index!r}]")
+        lines.append(f"{indent}except (IndexError, KeyError, TypeError):")
+        lines.append(f"{indent}    {child_variable} = None")
+        lines.append(f"{indent}if {child_variable} is None:")
+        for name in child.names:
+            lines.append(f"{indent}    r[{name!r}] = None")
+        lines.append(f"{indent}else:")
+        _generate(child, child_variable, depth + 1, namespace, lines)
+
+
+def compile_spec(spec):
+    """
+    Compiles a field spec into a function that turns a nested array into a
+    flat dictionary of the fields. The function is generated as straight-line
+    code following every path once, so paths sharing a prefix are indexed
+    once, and fields whose path is missing from the array are None.
+    """
+    root = _Node()
+    for name, (kind, path, option) in spec.items():
+        node = root
+        node.names.append(name)
+        for index in path:
+            node = node.children.setdefault(index, _Node())
+            node.names.append(name)
+        if kind == 'each':
+            node.fields.append((name, compile_spec(option), True))
+        else:
+            node.fields.append((name, option, False))
+
+    namespace = {}
+    lines = ['def extract(v1):', '    r = {}']
+    _generate(root, 'v1', 1, namespace, lines)
+    lines.append('    return r')
+    exec('\n'.join(lines), namespace)
+    return namespace['extract']
+
+
+parse_panorama = compile_spec(PANORAMA_SPEC)
+
+
+def parse_map_data(content):
+    """
+    Decodes a raw photometa response and extracts the panorama. Returns a
+    dictionary with the data, or an empty dictionary.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    content = content.lstrip()
+    if content.startswith(XSSI_PREFIX):
+        content = content[len(XSSI_PREFIX):]
+    try:
+        data = loads(content)
+    except ValueError:
+        return {}
+    if type(data) is not list:
+        return {}
+    panorama = parse_panorama(data)
+    return panorama if panorama['pano_id'] is not None else {}
+
+
+def iter_map_files(filenames):
+    """
+    Yields the panorama of every saved response in `filenames`, reading one
+    file at a time. Each panorama has the name of its file under 'source'.
+    Files that are not photometa responses are skipped.
+    """
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        except OSError as e:
+            logger.warning(f"Could not read {filename}: {e}")
+            continue
+        panorama = parse_map_data(content)
+        if not panorama:
+            logger.warning(f"No panorama in {filename}")
+            continue
+        panorama['source'] = os.path.basename(filename)
+        yield panorama
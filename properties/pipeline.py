@@ -0,0 +1,148 @@
+# pipeline.py
+
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from extract import parse_next_data
+from coordinates import decompress_body, sales_coordinates
+
+logger = logging.getLogger(__name__)
+
+
+def parse_payload(payload):
+    """
+    Parses the raw payloads of a property page in a worker process: extracts
+    the property information from __NEXT_DATA__ and decodes the saleMap
+    response. Returns the property information, the coordinates of the sales
+    in the saleMap response, the decoded saleMap response and the seconds
+    spent parsing. The saleMap response is None if it could not be decoded.
+    """
+    start = time.perf_counter()
+    property_info = {}
+    if payload.get('next_data') is not None:
+        property_info = parse_next_data(payload['next_data'], payload['listing_id'])
+    latitude, longitude = None, None
+
+    coordinates = {}
+    sale_map = None
+    if payload.get('sale_map') is not None:
+        try:
+            body = decompress_body(payload['sale_map'], payload.get('content_encoding'))
+            coordinates = sales_coordinates(json.loads(body))
+            # The map also holds the sales around the listing
+            latitude, longitude = coordinates.get(str(payload['listing_id']), (None, None))
+            sale_map = body
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            coordinates = {}
+            logger.warning(f"Could not decode the saleMap response of {payload['link']}: {e}")
+
+    if property_info:
+        property_info['latitude'] = latitude
+        property_info['longitude'] = longitude
+    return property_info, coordinates, sale_map, time.perf_counter() - start
+
+
+class Pipeline:
+    """
+    Pipeline separating fetching from parsing. Fetch workers `put` raw
+    payloads on a bounded queue, a process pool parses them with `parse`,
+    and a writer thread hands each payload and its result to `write`.
+
+    At most `queue_size` payloads are queued and as many are being parsed or
+    waiting for the writer, so `put` blocks the fetch workers when parsing
+    or writing falls behind and memory stays bounded.
+    """
+
+    def __init__(self, write, parse=parse_payload, processes=None, queue_size=100):
+        self.write = write
+        self.parse = parse
+        self.payloads = queue.Queue(maxsize=queue_size)
+        self._results = queue.Queue()
+        self._in_flight = threading.BoundedSemaphore(queue_size)
+        self._pending = 0
+        self._drained = threading.Condition()
+        self.processes = processes
+        self._executor = self._new_executor()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._dispatcher.start()
+        self._writer.start()
+
+    def _new_executor(self):
+        # Forking would copy the drivers' threads and locks into the workers
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit(self, payload):
+        try:
+            return self._executor.submit(self.parse, payload)
+        except BrokenProcessPool:
+            # A parse process died, e.g. killed for its memory. The payloads
+            # it had fail in the writer, later ones go to a new pool
+            logger.error("A parse process died, starting a new process pool")
+            self._executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+            return self._executor.submit(self.parse, payload)
+
+    def _done(self):
+        self._in_flight.release()
+        with self._drained:
+            self._pending -= 1
+            self._drained.notify_all()
+
+    def put(self, payload):
+        """Queues a payload, blocking while the queue is full."""
+        with self._drained:
+            self._pending += 1
+        self.payloads.put(payload)
+
+    def _dispatch(self):
+        while True:
+            payload = self.payloads.get()
+            if payload is None:
+                return
+            self._in_flight.acquire()
+            try:
+                future = self._submit(payload)
+            except Exception as e:
+                logger.error(f"Could not parse {payload.get('link')}: {e}")
+                self._done()
+                continue
+            future.add_done_callback(lambda future, payload=payload: self._results.put((payload, future)))
+
+    def _write(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            payload, future = item
+            try:
+                self.write(payload, future.result())
+            except Exception as e:
+                logger.error(f"Error writing {payload.get('link')}: {e}")
+            finally:
+                self._done()
+
+    def drain(self):
+        """Waits until every payload put so far has been written."""
+        with self._drained:
+            self._drained.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        """Writes the queued payloads and stops the stages."""
+        self.payloads.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+        self._results.put(None)
+        self._writer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,236 @@
+# pool.py
+
+import logging
+import queue
+import threading
+import time
+
+from selenium.common.exceptions import InvalidSessionIdException
+from urllib3.exceptions import HTTPError
+
+from utils import setup_driver
+from driver_factory import DriverFactory
+
+logger = logging.getLogger(__name__)
+
+# Errors of a browser that crashed or went away, after which its driver is useless
+CRASH_MESSAGES = ('chrome not reachable', 'disconnected', 'session deleted', 'tab crashed')
+
+
+def driver_crashed(error):
+    """Tells whether a task failed because its browser or chromedriver is gone."""
+    if isinstance(error, (InvalidSessionIdException, ConnectionError, HTTPError)):
+        return True
+    message = str(error).lower()
+    return any(crash in message for crash in CRASH_MESSAGES)
+
+
+class DriverPool:
+    """
+    Pool of worker threads, each with a dedicated driver and its own
+    Selenium Wire capture. Tasks are handed to the workers through a queue,
+    and the drivers are kept across calls to `map`. Every task takes a token
+    from `limiter` first if one is given, and the drivers report the responses
+    they see to it. Task outcomes and page stages are counted in `metrics`
+    if given. Drivers come from a DriverFactory keeping `prewarm` drivers
+    started ahead, and `driver_options` are passed on to setup_driver.
+
+    A worker replaces its driver after `max_pages` tasks, or once
+    `memory(driver)` reports more than `max_rss` bytes for it. A watchdog
+    kills the driver of a task running longer than `task_timeout` seconds.
+    Tasks failing because their driver hung or crashed are queued again up
+    to `retries` times on a new driver.
+    """
+
+    def __init__(self, workers, limiter=None, metrics=None, prewarm=0, max_pages=None, max_rss=None,
+                 memory=None, task_timeout=None, retries=1, **driver_options):
+        if workers < 1:
+            raise ValueError(f"A driver pool needs at least one worker, got {workers}")
+        self.workers = workers
+        self.limiter = limiter
+        self.metrics = metrics
+        self.max_pages = max_pages
+        self.max_rss = max_rss
+        self.memory = memory
+        self.task_timeout = task_timeout
+        self.retries = retries
+        self.factory = DriverFactory(setup_driver, prewarm, limiter=limiter, metrics=metrics, **driver_options)
+        # Running drivers by worker, e.g. to measure their memory
+        self.drivers = {}
+        # Start time and driver of the running task by worker, and the
+        # workers whose driver the watchdog killed
+        self._busy = {}
+        self._hung = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._tasks = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._worker, args=(worker_id,), daemon=True)
+            for worker_id in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._watchdog = None
+        if task_timeout:
+            self._watchdog = threading.Thread(target=self._watch, daemon=True)
+            self._watchdog.start()
+
+    def _start(self, worker_id):
+        try:
+            driver = self.factory.get()
+        except Exception as e:
+            logger.error(f"[worker {worker_id}] Could not start a driver: {e}")
+            return None
+        self.drivers[worker_id] = driver
+        return driver
+
+    def _release(self, worker_id, driver):
+        self.drivers.pop(worker_id, None)
+        try:
+            self.factory.release(driver)
+        except Exception as e:
+            logger.warning(f"[worker {worker_id}] Could not quit the driver: {e}")
+
+    def _recycle(self, worker_id, driver, reason):
+        logger.info(f"[worker {worker_id}] Replacing the driver: {reason}")
+        if self.metrics is not None:
+            self.metrics.inc('driver_recycles', reason=reason)
+        self._release(worker_id, driver)
+        with self._lock:
+            self._hung.discard(worker_id)
+        return self._start(worker_id)
+
+    def _recycle_reason(self, driver, pages):
+        if self.max_pages and pages >= self.max_pages:
+            return 'pages'
+        if self.max_rss and self.memory is not None:
+            try:
+                rss = self.memory(driver)
+            except Exception as e:
+                logger.warning(f"Could not measure the memory of a driver: {e}")
+                rss = None
+            if rss is not None and rss > self.max_rss:
+                return 'memory'
+        return None
+
+    def _watch(self):
+        interval = min(self.task_timeout / 4, 5)
+        while not self._stopped.wait(interval):
+            now = time.monotonic()
+            with self._lock:
+                hung = [
+                    (worker_id, driver) for worker_id, (started, driver) in self._busy.items()
+                    if now - started > self.task_timeout and worker_id not in self._hung
+                ]
+                self._hung.update(worker_id for worker_id, _ in hung)
+            for worker_id, driver in hung:
+                logger.warning(f"[worker {worker_id}] No answer from the driver in {self.task_timeout}s, killing it")
+                self.factory.kill(driver)
+
+    def _worker(self, worker_id):
+        driver = self._start(worker_id)
+        pages = 0
+        try:
+            while True:
+                job = self._tasks.get()
+                if job is None:
+                    return
+                task, index, item, done, attempt = job
+                if driver is None:
+                    driver = self._start(worker_id)
+                    pages = 0
+                    if driver is None:
+                        done.put((index, item, None, False))
+                        continue
+                logger.info(f"[worker {worker_id}] Scraping: {item}")
+                try:
+                    if self.limiter is not None:
+                        self.limiter.acquire()
+                    with self._lock:
+                        self._busy[worker_id] = (time.monotonic(), driver)
+                    result = task(driver, item)
+                except Exception as e:
+                    error = e
+                else:
+                    error = None
+                finally:
+                    with self._lock:
+                        self._busy.pop(worker_id, None)
+                        hung = worker_id in self._hung
+                pages += 1
+
+                reason = 'hung' if hung else 'crashed' if error is not None and driver_crashed(error) else None
+                if reason is not None:
+                    driver = self._recycle(worker_id, driver, reason)
+                    pages = 0
+                    if error is not None and attempt < self.retries:
+                        logger.warning(f"[worker {worker_id}] Retrying {item} on a new driver: {error}")
+                        if self.metrics is not None:
+                            self.metrics.inc('retries', source='browser', reason=reason)
+                        self._tasks.put((task, index, item, done, attempt + 1))
+                        continue
+                if error is not None:
+                    logger.error(f"[worker {worker_id}] Error scraping {item}: {error}")
+                    self._count('failure')
+                    done.put((index, item, None, False))
+                else:
+                    self._count('success')
+                    done.put((index, item, result, True))
+
+                if driver is not None and reason is None:
+                    reason = self._recycle_reason(driver, pages)
+                    if reason is not None:
+                        driver = self._recycle(worker_id, driver, reason)
+                        pages = 0
+        finally:
+            if driver is not None:
+                self._release(worker_id, driver)
+
+    def _count(self, result):
+        if self.metrics is not None:
+            self.metrics.inc('browser_tasks', result=result)
+
+    def map(self, task, items, on_result=None):
+        """
+        Calls `task(driver, item)` for every item on the pool's drivers.
+        `on_result(item, result)` is called as soon as an item succeeds.
+        Returns the results in the order of `items`, with None for failed items.
+        """
+        done = queue.Queue()
+        for index, item in enumerate(items):
+            self._tasks.put((task, index, item, done, 0))
+
+        results = [None] * len(items)
+        for _ in range(len(items)):
+            index, item, result, ok = done.get()
+            results[index] = result
+            if ok and on_result is not None:
+                on_result(item, result)
+        return results
+
+    def close(self, cancel=False):
+        """
+        Stops the workers once the queued tasks are done, or right after their
+        current task if `cancel` is set.
+        """
+        if cancel:
+            try:
+                while True:
+                    self._tasks.get_nowait()
+            except queue.Empty:
+                pass
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._stopped.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+        self.factory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+
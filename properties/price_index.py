@@ -0,0 +1,87 @@
+# price_index.py
+
+import argparse
+import logging
+import os
+import sys
+
+import pandas as pd
+
+# The modules in utils/ at the repository root are shadowed by
+# properties/utils.py, so they are imported from their directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from geo import POINTS_OF_INTEREST, distance_features
+from priceindex import PriceIndex
+from schema import PARTITIONED_SCHEMA
+from storage import load_parquet, save_to_parquet
+
+DATASET_DIR = 'properties/dataset'
+STATE_DIR = 'properties/price_index'
+INDEX_FILE = 'properties/price_index.parquet'
+MUNICIPALITY = 'Skellefteå kommun'
+
+COLUMNS = ['id', 'municipality', 'streetAddress', 'housingCooperative', 'sellingPrice', 'soldAt',
+           'livingArea', 'numberOfRooms', 'fee', 'constructionYear', 'latitude', 'longitude']
+
+
+def load_sales(dataset_dir, municipality=None, since=None):
+    """
+    Loads the sold listings of a municipality, only from the months from
+    `since` on if given, with their distance to Northvolt Ett.
+    """
+    filters = []
+    if municipality:
+        filters.append(('municipality', '=', municipality))
+    if since is not None:
+        filters.append(('soldMonth', '>=', since.strftime('%Y-%m')))
+    df = load_parquet(dataset_dir, columns=COLUMNS, filters=filters or None, schema=PARTITIONED_SCHEMA)
+    distances = distance_features(df, {'northvolt_ett': POINTS_OF_INTEREST['northvolt_ett']})
+    return pd.concat([df, distances], axis=1)
+
+
+def update_index(dataset_dir=DATASET_DIR, state_dir=STATE_DIR, output_file=INDEX_FILE,
+                 municipality=MUNICIPALITY, window=8, lookback_months=3, full=False):
+    """
+    Adds the sales scraped since the last run to the price index and writes
+    the quarterly index. Only the months from `lookback_months` before the
+    latest sale already in the index are read, as listings can be scraped
+    some time after they were sold. With `full`, the index is rebuilt from
+    every sale in the dataset.
+    """
+    index = None
+    if not full and os.path.exists(os.path.join(state_dir, 'moments.npz')):
+        index = PriceIndex.load(state_dir)
+        if index.window != window:
+            logging.info(f"Window changed from {index.window} to {window} quarters, rebuilding the index")
+            index = None
+    if index is None:
+        index = PriceIndex(window)
+
+    since = index.last_sold - pd.DateOffset(months=lookback_months) if len(index) else None
+    sales = load_sales(dataset_dir, municipality, since)
+    added = index.add(sales)
+    logging.info(f"Added {added} of {len(sales)} sales read, {len(index)} sales in the index")
+    index.save(state_dir)
+
+    result = index.index()
+    save_to_parquet(result, output_file)
+    logging.info(f"Price index saved to {output_file}\n{result.tail(8).to_string(index=False)}")
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Update the quarterly hedonic and repeat sales price index.')
+    parser.add_argument('--dataset', default=DATASET_DIR, help=f'Dataset to read (default: {DATASET_DIR})')
+    parser.add_argument('--state', default=STATE_DIR, help=f'Directory of the index state (default: {STATE_DIR})')
+    parser.add_argument('--output', default=INDEX_FILE, help=f'Parquet file to write (default: {INDEX_FILE})')
+    parser.add_argument('--municipality', default=MUNICIPALITY,
+                        help=f'Municipality to index, empty for all (default: {MUNICIPALITY})')
+    parser.add_argument('--window', type=int, default=8,
+                        help='Quarters per hedonic regression window')
+    parser.add_argument('--lookback', type=int, default=3,
+                        help='Months before the latest indexed sale to read again for late listings')
+    parser.add_argument('--full', action='store_true', help='Rebuild the index from every sale')
+    args = parser.parse_args()
+    update_index(args.dataset, args.state, args.output, args.municipality, args.window, args.lookback,
+                 args.full)
@@ -0,0 +1,95 @@
+# readiness.py
+
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+
+logger = logging.getLogger(__name__)
+
+# Per-signal timeouts in seconds
+TIMEOUTS = {
+    'next_data': 10,
+    'sale_map': 5,
+}
+
+POLL_FREQUENCY = 0.1
+
+# Running count, total and max of the seconds spent waiting on each signal,
+# and how many waits timed out, so long runs keep no per-wait history
+wait_timings = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+wait_timeouts = defaultdict(int)
+_timings_lock = threading.Lock()
+
+
+def wait_for(signal, driver, condition, timeout=None):
+    """
+    Waits until `condition(driver)` returns a truthy value and records how
+    long the wait took. Returns that value, or None if the wait timed out.
+    """
+    if timeout is None:
+        timeout = TIMEOUTS[signal]
+    start = time.perf_counter()
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY).until(condition)
+    except TimeoutException:
+        with _timings_lock:
+            wait_timeouts[signal] += 1
+        logger.warning(f"Timed out after {timeout}s waiting for {signal}")
+        return None
+    finally:
+        elapsed = time.perf_counter() - start
+        with _timings_lock:
+            timings = wait_timings[signal]
+            timings['count'] += 1
+            timings['total'] += elapsed
+            timings['max'] = max(timings['max'], elapsed)
+        if getattr(driver, 'metrics', None) is not None:
+            driver.metrics.observe('stage_seconds', elapsed, stage=f'wait_{signal}')
+
+
+def find_sale_map_response(driver):
+    """
+    Returns the saleMap GraphQL response kept by the driver's response
+    interceptor, or None if it has not arrived yet.
+    """
+    return driver.sale_map_response
+
+
+def wait_for_next_data(driver, timeout=None):
+    """
+    Waits for the __NEXT_DATA__ <script> tag. Returns the element, or None.
+    """
+    return wait_for(
+        'next_data', driver, EC.presence_of_element_located((By.ID, '__NEXT_DATA__')), timeout
+    )
+
+
+def wait_for_sale_map(driver, timeout=None):
+    """
+    Waits for the page to receive the saleMap GraphQL response.
+    Returns the response, or None.
+    """
+    return wait_for('sale_map', driver, find_sale_map_response, timeout)
+
+
+def summarize_wait_timings():
+    """
+    Summarizes the recorded waits per signal.
+    Returns a dictionary with count, timeouts, mean and max in seconds.
+    """
+    summary = {}
+    with _timings_lock:
+        for signal, timings in wait_timings.items():
+            summary[signal] = {
+                'count': timings['count'],
+                'timeouts': wait_timeouts[signal],
+                'mean': timings['total'] / timings['count'],
+                'max': timings['max'],
+            }
+    return summary
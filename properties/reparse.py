@@ -0,0 +1,140 @@
+# reparse.py
+
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from extract import parse_next_data
+from coordinates import CoordinateCache, fill_coordinates, sales_coordinates
+
+# The modules in utils/ at the repository root are shadowed by
+# properties/utils.py, so they are imported from their directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from archive import PageArchive, load_object, NEXT_DATA, SALE_MAP
+from schema import (SOLD_LISTING_SCHEMA, PARTITIONED_SCHEMA, PARTITION_COLUMNS, listing_row,
+                    unflatten_row, with_sold_month)
+from storage import ParquetSink, write_dataset
+
+ARCHIVE_DIR = 'properties/archive'
+COORDINATES_FILE = 'properties/coordinates.json'
+OUTPUT_FILE = 'properties/properties.parquet'
+DATASET_DIR = 'properties/dataset'
+
+
+def parse_sale_map(directory, digest):
+    """Returns the coordinates of the sales in an archived saleMap response."""
+    try:
+        return sales_coordinates(json.loads(load_object(directory, digest)))
+    except ValueError:
+        return {}
+
+
+def parse_listing(directory, item):
+    """Extracts the property information of an archived __NEXT_DATA__ payload."""
+    listing_id, digest = item
+    return parse_next_data(load_object(directory, digest), listing_id)
+
+
+def keep_previous(sink, filename, rebuilt_ids, batch_size=1000):
+    """
+    Writes the rows of an existing output file whose id was not rebuilt, so
+    sales scraped before the archive existed are kept. Rows of a file
+    flattened by an earlier version are converted to SOLD_LISTING_SCHEMA.
+    Returns the number of rows kept.
+    """
+    if not os.path.exists(filename):
+        return 0
+    previous = pq.ParquetFile(filename)
+    current = previous.schema_arrow.equals(SOLD_LISTING_SCHEMA)
+    rebuilt = pa.array(list(rebuilt_ids), pa.string())
+    kept = 0
+    for batch in previous.iter_batches(batch_size=batch_size):
+        batch = batch.filter(pc.invert(pc.is_in(batch['id'], rebuilt)))
+        kept += batch.num_rows
+        if current:
+            sink.write_table(batch)
+        else:
+            for row in batch.to_pylist():
+                sink.write(listing_row(unflatten_row(row)))
+    return kept
+
+
+def reparse(archive_dir=ARCHIVE_DIR, output_file=OUTPUT_FILE, dataset_dir=DATASET_DIR,
+            processes=None, batch_size=1000, chunksize=64, replace=False):
+    """
+    Rebuilds the Parquet output and the partitioned dataset from the archived
+    payloads, parsing them on `processes` worker processes (default: all
+    cores). Coordinates come from the archived saleMap responses, then from
+    the coordinate cache. The rows of `output_file` that are not in the
+    archive are kept, unless `replace` is set.
+    Returns the number of properties written.
+    """
+    archive = PageArchive(archive_dir)
+    listings = [
+        (listing_id, kinds[NEXT_DATA]) for listing_id, kinds in archive.index.items()
+        if NEXT_DATA in kinds
+    ]
+    sale_maps = {kinds[SALE_MAP] for kinds in archive.index.values() if SALE_MAP in kinds}
+    archive.close()
+    logging.info(f"Re-parsing {len(listings)} listings and {len(sale_maps)} saleMap responses")
+
+    coordinates = CoordinateCache(COORDINATES_FILE)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for sales in executor.map(functools.partial(parse_sale_map, archive_dir), sale_maps,
+                                  chunksize=chunksize):
+            coordinates.update(sales)
+
+        failed = 0
+        kept = 0
+        rebuilt_ids = set()
+        with ParquetSink(output_file, SOLD_LISTING_SCHEMA, batch_size) as sink:
+            for property_info in executor.map(functools.partial(parse_listing, archive_dir), listings,
+                                              chunksize=chunksize):
+                if not property_info:
+                    failed += 1
+                    continue
+                fill_coordinates(property_info, coordinates)
+                row = listing_row(property_info)
+                rebuilt_ids.add(row['id'])
+                sink.write(row)
+            if not replace:
+                kept = keep_previous(sink, output_file, rebuilt_ids, batch_size)
+
+    logging.info(f"Wrote {sink.rows} properties to {output_file}, {kept} of them kept from it, "
+                 f"{failed} payloads could not be parsed")
+
+    if dataset_dir:
+        batches = (
+            with_sold_month(batch)
+            for batch in pq.ParquetFile(output_file).iter_batches(batch_size=batch_size)
+        )
+        write_dataset(batches, dataset_dir, PARTITIONED_SCHEMA, PARTITION_COLUMNS, replace=True)
+        logging.info(f"Dataset saved to {dataset_dir}")
+    return sink.rows
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description='Rebuild the Parquet output from the page archive, without going back to Hemnet.'
+    )
+    parser.add_argument('--archive', default=ARCHIVE_DIR, help=f'Archive directory (default: {ARCHIVE_DIR})')
+    parser.add_argument('--output', default=OUTPUT_FILE, help=f'Parquet file to write (default: {OUTPUT_FILE})')
+    parser.add_argument('--dataset', default=DATASET_DIR,
+                        help=f'Partitioned dataset to rewrite, empty to skip it (default: {DATASET_DIR})')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of parsing processes (default: number of cores)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of properties per Parquet row group')
+    parser.add_argument('--replace', action='store_true',
+                        help='Only write the archived listings, dropping the other rows of the output file')
+    args = parser.parse_args()
+    reparse(args.archive, args.output, args.dataset, args.processes, args.batch_size, replace=args.replace)
@@ -0,0 +1,120 @@
+# scheduler.py
+
+import logging
+
+from utils import get_total_pages
+from fetch import PropertyFetcher
+from links import collect_links
+from extract import listing_id_from_url
+
+logger = logging.getLogger(__name__)
+
+
+class Location:
+    """
+    Scrape state of one location: its checkpoint, the links left to scrape
+    and how many of them have been scraped. Progress is logged every
+    `report_every` properties.
+    """
+
+    def __init__(self, location_id, checkpoint, report_every=25):
+        self.location_id = location_id
+        self.checkpoint = checkpoint
+        self.report_every = report_every
+        self.pending = []
+        self.scraped = 0
+
+    def add_record(self, link, record):
+        self.checkpoint.add_record(link, record)
+        self.scraped += 1
+        if self.scraped % self.report_every == 0:
+            logger.info(self.progress())
+
+    def progress(self):
+        return f"location {self.location_id}: {self.scraped}/{len(self.pending)} properties scraped"
+
+
+def collect_location_links(pool, locations, known_ids=None):
+    """
+    Collects the property links of every location whose checkpoint does not
+    have them yet, then sets the links left to scrape of each location. A
+    listing found in several locations is only scraped for the first one.
+    Returns the locations with the most new sales first.
+    """
+    todo = [location for location in locations if not location.checkpoint.links_complete]
+    total_pages = pool.map(lambda driver, location: get_total_pages(driver, location.location_id), todo)
+    for location, pages in zip(todo, total_pages):
+        pages = pages or 1
+        logger.info(f"Location {location.location_id} has {pages} pages of sales")
+        _, complete = collect_links(pool, location.location_id, pages,
+                                    start_page=location.checkpoint.pages_done + 1,
+                                    known_ids=known_ids, on_page=location.checkpoint.add_links)
+        # Pages that did not load are collected again by the next run
+        if complete:
+            location.checkpoint.complete_links()
+
+    seen = set()
+    for location in locations:
+        location.pending = []
+        for link in location.checkpoint.pending_links():
+            if link in seen or (known_ids and listing_id_from_url(link) in known_ids):
+                continue
+            seen.add(link)
+            location.pending.append(link)
+
+    locations = sorted(locations, key=lambda location: len(location.pending), reverse=True)
+    for location in locations:
+        logger.info(f"Location {location.location_id} has {len(location.pending)} new sales to scrape")
+    return locations
+
+
+def fetch_locations(locations, pipeline, concurrency=20, fixture_store=None, limiter=None, metrics=None):
+    """
+    Fetches the pending property pages of the locations over plain HTTP, in
+    order, and puts the raw payloads on the pipeline to be parsed and
+    written. Returns the links per location that still need the browser.
+    """
+    batch_size = concurrency * 5
+    with PropertyFetcher(concurrency, fixture_store, limiter, metrics) as fetcher:
+        for location in locations:
+            pending = [link for link in location.pending if link not in location.checkpoint.done]
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                for payload in fetcher.fetch(batch):
+                    if payload is not None:
+                        pipeline.put(payload)
+    pipeline.drain()
+    left = {}
+    for location in locations:
+        logger.info(location.progress())
+        left[location.location_id] = [
+            link for link in location.pending if link not in location.checkpoint.done
+        ]
+    return left
+
+
+def link_owners(locations, links=None):
+    """
+    Maps the links to scrape to their location, in the order of `locations`.
+    `links` maps location IDs to the links to scrape, by default the pending
+    ones.
+    """
+    owner = {}
+    for location in locations:
+        for link in (links or {}).get(location.location_id, location.pending):
+            owner[link] = location
+    return owner
+
+
+def scrape_locations(pool, locations, task, pipeline, links=None):
+    """
+    Scrapes the links of all locations on the shared pool, queued in the
+    order of `locations` so the workers move on to the next location without
+    waiting for the last one to finish. `task` fetches the raw payloads,
+    which the workers put on the pipeline to be parsed and written.
+    """
+    owner = link_owners(locations, links)
+    pool.map(lambda driver, link: pipeline.put(task(driver, link)), list(owner))
+    pipeline.drain()
+    for location in locations:
+        logger.info(location.progress())
@@ -0,0 +1,92 @@
+# street_view.py
+
+import argparse
+import glob
+import logging
+import os
+import sys
+
+import pandas as pd
+
+from mapdata import iter_map_files
+
+# The modules in utils/ at the repository root are shadowed by
+# properties/utils.py, so they are imported from their directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils'))
+from geo import SpatialIndex
+from schema import PARTITIONED_SCHEMA, STREET_VIEW_SCHEMA
+from storage import ParquetSink, load_parquet, save_to_parquet
+
+OUTPUT_FILE = 'properties/street_view.parquet'
+DATASET_DIR = 'properties/dataset'
+LISTING_PANORAMAS_FILE = 'properties/listing_panoramas.parquet'
+
+
+def find_map_files(paths):
+    """Expands directories and glob patterns into the saved response files, sorted."""
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(glob.glob(os.path.join(path, '**', '*.json'), recursive=True))
+        else:
+            filenames.extend(glob.glob(path, recursive=True))
+    return sorted(set(filenames))
+
+
+def parse_map_files(filenames, output_file=OUTPUT_FILE, batch_size=1000):
+    """
+    Parses saved photometa responses into one row per panorama, streamed to
+    `output_file` a row group at a time. Returns the number of panoramas.
+    """
+    with ParquetSink(output_file, STREET_VIEW_SCHEMA, batch_size) as sink:
+        for panorama in iter_map_files(filenames):
+            sink.write(panorama)
+    logging.info(f"Wrote {sink.rows} panoramas of {len(filenames)} files to {output_file}")
+    return sink.rows
+
+
+def match_listings(panoramas_file=OUTPUT_FILE, dataset_dir=DATASET_DIR,
+                   output_file=LISTING_PANORAMAS_FILE, radius_km=0.1):
+    """
+    Matches every sold listing with the nearest panorama within `radius_km`
+    and writes the listing id with the panorama's id, distance and capture
+    date.
+    """
+    panoramas = load_parquet(panoramas_file, columns=['pano_id', 'latitude', 'longitude',
+                                                      'capture_year', 'capture_month'])
+    panoramas = panoramas.drop_duplicates('pano_id').reset_index(drop=True)
+    listings = load_parquet(dataset_dir, columns=['id', 'latitude', 'longitude'], schema=PARTITIONED_SCHEMA)
+    index = SpatialIndex.from_frame(panoramas)
+
+    matches = []
+    for listing in listings.dropna(subset=['latitude', 'longitude']).itertuples(index=False):
+        positions, distances = index.within(listing.latitude, listing.longitude, radius_km)
+        if len(positions):
+            matches.append({'id': listing.id, 'position': positions[0], 'distance_km': distances[0]})
+
+    matched = pd.DataFrame(matches, columns=['id', 'position', 'distance_km'])
+    matched = matched.join(panoramas.drop(columns=['latitude', 'longitude']), on='position').drop(columns='position')
+    save_to_parquet(matched, output_file)
+    logging.info(f"Matched {len(matched)} of {len(listings)} listings with a panorama, saved to {output_file}")
+    return matched
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description='Parse saved Google Maps photometa responses into Street View panorama records.'
+    )
+    parser.add_argument('paths', nargs='+', help='Response files, directories or glob patterns')
+    parser.add_argument('--output', default=OUTPUT_FILE, help=f'Parquet file to write (default: {OUTPUT_FILE})')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of panoramas per row group')
+    parser.add_argument('--match', action='store_true',
+                        help=f'Match the sold listings with their nearest panorama into {LISTING_PANORAMAS_FILE}')
+    parser.add_argument('--radius', type=float, default=0.1,
+                        help='Largest distance in km between a listing and its panorama')
+    args = parser.parse_args()
+    filenames = find_map_files(args.paths)
+    if not filenames:
+        raise SystemExit(f"No response files found in {' '.join(args.paths)}")
+    parse_map_files(filenames, args.output, args.batch_size)
+    if args.match:
+        match_listings(args.output, radius_km=args.radius)
@@ -1,22 +1,142 @@
 # utils.py
 
+import os
+import re
+import time
+from urllib.parse import urlsplit
+from contextlib import nullcontext
+
 from seleniumwire import webdriver  # Import from seleniumwire
+from seleniumwire.utils import decode
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.by import By
-import time
-import json
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from io import BytesIO
-import gzip
+from readiness import wait_for_next_data, wait_for_sale_map
+from extract import listing_id_from_url
+from coordinates import capture_template
+from fetch import BASE_URL, rebase_url
+from driver_factory import WARM_START_ARGUMENTS, chromedriver_path
+
+# Only requests to the GraphQL endpoint are captured by Selenium Wire, on
+# Hemnet or on the local stand-in at BASE_URL
+GRAPHQL_SCOPE = rf'(?:.*hemnet\.se|{re.escape(BASE_URL)})/.*graphql.*'
+
+# Pages captured as well when recording fixtures
+RECORD_SCOPE = rf'{re.escape(BASE_URL)}/salda.*'
+
+# Chrome sends loopback requests around the proxy unless told otherwise
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+# Hosts of the analytics, ad and consent scripts on Hemnet pages
+TRACKER_URLS = (
+    '*googletagmanager.com*', '*google-analytics.com*', '*doubleclick.net*',
+    '*googlesyndication.com*', '*adservice.google.*', '*amazon-adsystem.com*',
+    '*adnxs.com*', '*criteo.com*', '*connect.facebook.net*', '*hotjar.com*',
+    '*scorecardresearch.com*', '*cookielaw.org*', '*onetrust.com*', '*sentry.io*',
+)
+FONT_URLS = ('*.woff2*', '*.woff*', '*.ttf*', '*.otf*')
+MEDIA_URLS = ('*.mp4*', '*.webm*', '*.m3u8*')
+
+# What is kept from loading the pages: images through Chrome's content
+# settings, and URL patterns through the DevTools protocol, so the requests
+# never leave the browser. Only __NEXT_DATA__ and the saleMap response are
+# read from a page.
+BLOCKING_PROFILES = {
+    'off': {'prefs': {}, 'urls': ()},
+    'assets': {
+        'prefs': {'profile.managed_default_content_settings.images': 2},
+        'urls': FONT_URLS + MEDIA_URLS + TRACKER_URLS,
+    },
+    # Stylesheets and map tiles as well, the page is not rendered faithfully
+    'strict': {
+        'prefs': {'profile.managed_default_content_settings.images': 2},
+        'urls': FONT_URLS + MEDIA_URLS + TRACKER_URLS + ('*.css*', '*maps.googleapis.com/maps/vt*',
+                                                         '*maps.gstatic.com*'),
+    },
+}
+
+def capture_sale_map(driver, fixture_store=None, limiter=None):
+    """
+    Returns a response interceptor that keeps the saleMap GraphQL request
+    and response on `driver.sale_map_request` and `driver.sale_map_response`.
+    Every captured response is also recorded in `fixture_store` and reported
+    to `limiter` if they are given.
+    """
+    def interceptor(request, response):
+        if limiter is not None:
+            limiter.observe(response.status_code, response.headers)
+        if fixture_store is not None:
+            content = decode(response.body, response.headers.get('Content-Encoding', 'identity'))
+            fixture_store.save(request.method, request.url, request.body,
+                               response.status_code, response.headers.items(), content)
+        if request.body and b'"operationName":"saleMap"' in request.body:
+            driver.sale_map_request = request
+            driver.sale_map_response = response
+    return interceptor
+
+def reset_capture(driver):
+    """
+    Drops everything Selenium Wire has captured so far.
+    """
+    del driver.requests
+    driver.sale_map_request = None
+    driver.sale_map_response = None
+
+def timed(driver, stage):
+    """
+    Times a block in the driver's metrics as `stage`, if it has metrics.
+    """
+    metrics = getattr(driver, 'metrics', None)
+    return metrics.time(stage) if metrics is not None else nullcontext()
 
-def setup_driver():
+def page_transfer(driver):
+    """
+    Returns the bytes the browser transferred for the current page and the
+    number of requests it made, or None if they can't be read.
+    """
+    try:
+        transferred, requests = driver.execute_script(
+            "const entries = performance.getEntries();"
+            "return [entries.reduce((sum, e) => sum + (e.transferSize || 0), 0), entries.length]"
+        )
+    except Exception:
+        return None
+    return transferred or 0, requests or 0
+
+def record_page_bytes(driver):
+    """
+    Adds the bytes the browser transferred for the current page and its
+    requests to the driver's metrics, labelled with the blocking profile.
+    """
+    if getattr(driver, 'metrics', None) is None:
+        return
+    transfer = page_transfer(driver)
+    if transfer is None:
+        return
+    block = getattr(driver, 'block', 'off')
+    driver.metrics.inc('bytes', transfer[0], source='browser')
+    driver.metrics.inc('browser_pages', block=block)
+    driver.metrics.inc('browser_page_bytes', transfer[0], block=block)
+    driver.metrics.inc('browser_page_requests', transfer[1], block=block)
+
+def setup_driver(fixture_store=None, limiter=None, archive=None, metrics=None, driver_path=None,
+                 profile_dir=None, block='off'):
     """
     Setup the Selenium WebDriver with Selenium Wire capabilities.
+    With a fixture store, the property and result pages and the GraphQL
+    responses are recorded in it. With a rate limiter, the captured responses
+    and captcha pages are reported to it. With a page archive, the
+    __NEXT_DATA__ and saleMap payloads of the property pages are kept in it.
+    With metrics, the time spent in each stage of a page is recorded.
+    The chromedriver at `driver_path` is used if given, the cached one
+    otherwise, and the browser runs on `profile_dir` if given. `block` names
+    the BLOCKING_PROFILES entry of the resources kept from loading.
     """
+    blocking = BLOCKING_PROFILES[block]
+    start = time.perf_counter()
     chrome_options = Options()
     chrome_options.add_argument("--headless") 
     chrome_options.add_argument("--no-sandbox")
@@ -25,229 +145,101 @@ def setup_driver():
     chrome_options.add_argument('--disable-extensions')
     chrome_options.add_argument('--disable-blink-features=AutomationControlled')
     chrome_options.add_argument('--disable-infobars')
-
-    # Initialize WebDriver using ChromeDriverManager
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+    for argument in WARM_START_ARGUMENTS:
+        chrome_options.add_argument(argument)
+    if profile_dir is not None:
+        chrome_options.add_argument(f'--user-data-dir={os.path.abspath(profile_dir)}')
+    if urlsplit(BASE_URL).hostname in LOOPBACK_HOSTS:
+        # Send the stand-in's traffic through Selenium Wire as well
+        chrome_options.add_argument('--proxy-bypass-list=<-loopback>')
+    if blocking['prefs']:
+        chrome_options.add_experimental_option('prefs', blocking['prefs'])
+    # Return from driver.get at DOMContentLoaded, the readiness waits
+    # take care of the rest
+    chrome_options.page_load_strategy = 'eager'
+
+    # Bound the capture store in case a page fires many GraphQL calls
+    seleniumwire_options = {
+        'request_storage': 'memory',
+        'request_storage_max_size': 50,
+    }
+
+    # Initialize WebDriver with the chromedriver resolved once by ChromeDriverManager
+    driver = webdriver.Chrome(
+        service=Service(driver_path or chromedriver_path()),
+        options=chrome_options,
+        seleniumwire_options=seleniumwire_options,
+    )
+    if blocking['urls']:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': list(blocking['urls'])})
+    driver.block = block
+    driver.scopes = [GRAPHQL_SCOPE] if fixture_store is None else [GRAPHQL_SCOPE, RECORD_SCOPE]
+    driver.sale_map_request = None
+    driver.sale_map_response = None
+    driver.limiter = limiter
+    driver.archive = archive
+    driver.metrics = metrics
+    if metrics is not None:
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage='driver_startup')
+    driver.response_interceptor = capture_sale_map(driver, fixture_store, limiter)
     return driver
 
-def extract_coordinates(driver):
+def report_missing_page(driver):
     """
-    Extracts the coordinates from the GraphQL response.
+    Reports a page whose content did not show up to the driver's rate
+    limiter, which slows down if it is a captcha.
     """
-    # Clear previous requests
-    del driver.requests
-
-    # Wait for network requests to complete
-    time.sleep(1)
-
-    # Iterate over all intercepted requests
-    for request in driver.requests:
-        if 'graphql' in request.url:
-            try:
-                # Decode the request body
-                request_body = request.body.decode('utf-8')
-                if '"operationName":"saleMap"' in request_body:
-                    # Decode the response body
-                        response_body = request.response.body
-                        if request.response.headers.get('Content-Encoding') == 'gzip':
-                            buf = BytesIO(response_body)
-                            f = gzip.GzipFile(fileobj=buf)
-                            response_body = f.read()
-                        else:
-                            response_body = response_body.decode('utf-8')
-
-                        data = json.loads(response_body)
-                        # Extract coordinates
-                        coordinates = data['data']['sales'][0]['coordinates']
-                        lat = coordinates['lat']
-                        long = coordinates['long']
-                        return lat, long
-            except Exception as e:
-                print(f"Error extracting coordinates: {e}")
-    return None, None
+    if getattr(driver, 'limiter', None) is not None:
+        driver.limiter.observe(200, content=driver.page_source)
 
-def extract_property_info_from_json(driver):
+def fetch_property_payload(driver, link, coordinate_cache=None):
     """
-    Extracts the property information from the JSON data in the <script> tag.
-    Returns a dictionary with the data.
+    Loads a property page in the browser and returns its raw payloads for
+    the parse stage of the pipeline: the __NEXT_DATA__ JSON and the saleMap
+    response body, left undecoded. Listings already in the coordinate cache
+    are not waited for. A saleMap request template is included while the
+    cache has none.
     """
-    try:
-        # Wait for the script tag to be present
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.ID, '__NEXT_DATA__'))
-        )
-        # Find the <script> tag with id="__NEXT_DATA__"
-        script_tag = driver.find_element(By.ID, '__NEXT_DATA__')
-        json_content = script_tag.get_attribute('innerHTML')
-        data = json.loads(json_content)
-    except (NoSuchElementException, TimeoutException, json.JSONDecodeError):
-        return {}
-    
-    # Navigate through the JSON data to extract property information
-    try:
-        apollo_state = data['props']['pageProps']['__APOLLO_STATE__']
-        # The property ID is under 'SoldPropertyListing:<ID>'
-        # Extract the ID dynamically
-        for key in apollo_state.keys():
-            if key.startswith('SoldPropertyListing:'):
-                property_data = apollo_state[key]
-                break
-        else:
-            return {}
-    except KeyError:
-        return {}
-    
-    # Collect all property data
-    property_info = {}
-    
-    # Exclude image data and ad targeting
-    excluded_keys = ['attributedImages', 'adTargeting']
-
-    for key, value in property_data.items():
-        if key in excluded_keys:
-            continue
-
-        # Handle nested references
-        if isinstance(value, dict) and '__ref' in value:
-            ref_key = value['__ref']
-            referenced_data = apollo_state.get(ref_key, {})
-            property_info[key] = referenced_data
-        elif isinstance(value, list):
-            # For lists, process each item
-            processed_list = []
-            for item in value:
-                if isinstance(item, dict) and '__ref' in item:
-                    ref_key = item['__ref']
-                    referenced_data = apollo_state.get(ref_key, {})
-                    processed_list.append(referenced_data)
-                else:
-                    processed_list.append(item)
-            property_info[key] = processed_list
-        else:
-            property_info[key] = value
-
-    # Process nested fields and dereference as necessary
-    # (Same as previous code)
-    # Process 'broker' and 'brokerAgency'
-    if 'broker' in property_info and property_info['broker']:
-        broker_data = property_info['broker']
-        property_info['broker'] = {
-            'name': broker_data.get('name', ''),
-            'email': broker_data.get('email', ''),
-            'phoneNumber': broker_data.get('phoneNumber', ''),
-            'description': broker_data.get('description', ''),
-            'id': broker_data.get('id', ''),
-            'slug': broker_data.get('slug', ''),
-            'hasActiveProfile': broker_data.get('hasActiveProfile', False),
-            'canonicalUrl': broker_data.get('canonicalUrl', '')
-        }
-
-    if 'brokerAgency' in property_info and property_info['brokerAgency']:
-        agency_data = property_info['brokerAgency']
-        property_info['brokerAgency'] = {
-            'id': agency_data.get('id', ''),
-            'name': agency_data.get('name', ''),
-            'phoneNumber': agency_data.get('phoneNumber', ''),
-            'email': agency_data.get('email', ''),
-            'websiteUrl': agency_data.get('websiteUrl', ''),
-            'slug': agency_data.get('slug', ''),
-            'offersSellingPrices': agency_data.get('offersSellingPrices', False),
-            'isKronofogden': agency_data.get('isKronofogden', False),
-            'developer': agency_data.get('developer', False)
-        }
+    listing_id = listing_id_from_url(link)
+    reset_capture(driver)
+    with timed(driver, 'page_load'):
+        driver.get(rebase_url(link))
+    payload = {'link': link, 'listing_id': listing_id, 'url': driver.current_url, 'next_data': None}
 
-    # Process 'districts'
-    if 'districts' in property_info and property_info['districts']:
-        districts_list = []
-        for district in property_info['districts']:
-            district_data = district
-            districts_list.append({
-                'id': district_data.get('id', ''),
-                'fullName': district_data.get('fullName', ''),
-                '__typename': district_data.get('__typename', '')
-            })
-        property_info['districts'] = districts_list
-
-    # Process 'municipality' and 'county'
-    for loc_field in ['municipality', 'county']:
-        if loc_field in property_info and property_info[loc_field]:
-            loc_data = property_info[loc_field]
-            property_info[loc_field] = {
-                'id': loc_data.get('id', ''),
-                'fullName': loc_data.get('fullName', ''),
-                '__typename': loc_data.get('__typename', '')
-            }
-
-    # Process 'relevantAmenities'
-    if 'relevantAmenities' in property_info and property_info['relevantAmenities']:
-        amenities_list = []
-        for amenity in property_info['relevantAmenities']:
-            amenities_list.append({
-                'kind': amenity.get('kind', ''),
-                'isRelevant': amenity.get('isRelevant', False),
-                'isAvailable': amenity.get('isAvailable', False)
-            })
-        property_info['relevantAmenities'] = amenities_list
-
-    # Process 'housingForm' and 'tenure'
-    if 'housingForm' in property_info and property_info['housingForm']:
-        housing_form = property_info['housingForm']
-        property_info['housingForm'] = {
-            'name': housing_form.get('name', ''),
-            'symbol': housing_form.get('symbol', ''),
-            'primaryGroup': housing_form.get('primaryGroup', '')
-        }
-
-    if 'tenure' in property_info and property_info['tenure']:
-        tenure = property_info['tenure']
-        property_info['tenure'] = {
-            'name': tenure.get('name', ''),
-            'symbol': tenure.get('symbol', '')
-        }
-
-    # Process 'askingPrice', 'sellingPrice', 'priceChange', 'runningCosts'
-    money_fields = ['askingPrice', 'sellingPrice', 'priceChange', 'runningCosts']
-    for field in money_fields:
-        if field in property_info and property_info[field]:
-            money_data = property_info[field]
-            property_info[field] = {
-                'formatted': money_data.get('formatted', ''),
-                'amount': money_data.get('amount', None),
-                'amountInCents': money_data.get('amountInCents', None)
-            }
-
-    # Convert 'soldAt' timestamp to readable date
-    if 'soldAt' in property_info and property_info['soldAt']:
-        try:
-            sold_at_timestamp = float(property_info['soldAt'])
-            from datetime import datetime
-            sold_at_date = datetime.fromtimestamp(sold_at_timestamp)
-            property_info['soldAt'] = sold_at_date.strftime('%Y-%m-%d')
-        except ValueError:
-            pass  # Keep the original value if conversion fails
-
-    # Include fields that may be NULL in this instance
-    possible_fields = [
-        'fee', 'formattedFloor', 'squareMeterSellingPrice',
-        'yearlyArrendeFee', 'yearlyLeaseholdFee', 'housingCooperative'
-    ]
-    for field in possible_fields:
-        if field not in property_info:
-            property_info[field] = None  # Set to None if not present
-
-    return property_info
+    script_tag = wait_for_next_data(driver)
+    try:
+        if script_tag is not None:
+            payload['next_data'] = script_tag.get_attribute('innerHTML')
+    except NoSuchElementException:
+        pass
+    if payload['next_data'] is None:
+        report_missing_page(driver)
+
+    if coordinate_cache is None or listing_id not in coordinate_cache:
+        response = wait_for_sale_map(driver)
+        if response is not None:
+            payload['sale_map'] = response.body
+            payload['content_encoding'] = response.headers.get('Content-Encoding')
+            payload['sale_map_url'] = driver.sale_map_request.url
+            if coordinate_cache is not None and coordinate_cache.template is None and listing_id is not None:
+                payload['template'] = capture_template(driver.sale_map_request, listing_id)
+    reset_capture(driver)
+    record_page_bytes(driver)
+    return payload
 
 
 def get_property_links(driver, location_ids, page=1):
     """
     Extracts property links from the listing page.
-    Returns a list of URLs.
+    Returns a list of URLs, or None if the results did not load.
     """
-    base_url = 'https://www.hemnet.se/salda/bostader'
+    base_url = f'{BASE_URL}/salda/bostader'
     params = f'?location_ids={location_ids}&page={page}'
 
     url = base_url + params
-    driver.get(url)
+    with timed(driver, 'page_load'):
+        driver.get(url)
 
     # Wait for the property listings to load
     try:
@@ -255,7 +247,10 @@ def get_property_links(driver, location_ids, page=1):
             EC.presence_of_element_located((By.CSS_SELECTOR, 'div[data-testid="result-list"] a.Card_hclCard__v27k7'))
         )
     except TimeoutException:
-        return []
+        report_missing_page(driver)
+        return None
+    finally:
+        record_page_bytes(driver)
 
     property_links = []
 
@@ -275,7 +270,7 @@ def get_total_pages(driver, location_ids):
     """
     Determines the total number of pages in the listing.
     """
-    base_url = 'https://www.hemnet.se/salda/bostader'
+    base_url = f'{BASE_URL}/salda/bostader'
     params = f'?location_ids={location_ids}'
 
     url = base_url + params
@@ -1,14 +1,35 @@
 from requests_html import HTMLSession
 # from folder called utils and file called scraper-utils.py import the functions get_data and parse_html
 from utils.scraper import get_data, parse_html, collect_property_links
-from utils.storage import save_to_parquet, load_parquet
+from utils.storage import (save_to_parquet, load_parquet, write_dataset, ScrapeCache, conform_batch,
+                           dataset_schema)
+from utils.fixtures import FixtureStore
+from utils.ratelimit import RateLimiter
+from utils.registry import ListingRegistry
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import shutil
 import logging
-import time
-import random
+import sys
 
-def main(location_ids="location_ids%5B%5D=17860"):
+HEMNET_URL = "https://www.hemnet.se"
+
+# Point the scraper at a local stand-in with HEMNET_BASE_URL=http://127.0.0.1:8000
+HEMNET_BASE_URL = os.environ.get("HEMNET_BASE_URL", HEMNET_URL).rstrip("/")
+
+# Requests per second to start at, and to ramp up to while the site responds well
+RATE = 0.2
+MAX_RATE = 1.0
+
+# Listings fetched by earlier runs, whatever their date
+REGISTRY_FILE = "data/properties/registry.sqlite"
+
+# Every day's data, partitioned by scrape date
+DATASET_DIR = "data/properties/dataset"
+
+def main(location_ids=("17860",), record_dir=None):
     # Step 1: Collect the links to the properties
     # create a new HTML session
     session = HTMLSession()
@@ -16,7 +37,9 @@ def main(location_ids="location_ids%5B%5D=17860"):
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
     # set the params
-    base_url = f"https://www.hemnet.se/salda/bostader?{location_ids}"
+    # one search covers all the locations
+    query = "&".join(f"location_ids%5B%5D={location_id}" for location_id in location_ids)
+    base_url = f"{HEMNET_BASE_URL}/salda/bostader?{query}"
     min_area = 60
     max_area = 65
     step = 5
@@ -27,9 +50,15 @@ def main(location_ids="location_ids%5B%5D=17860"):
     # property links file
     property_links_file = f"data/properties/raw/hemnet_links_{date}.parquet"
 
-    # collect the property links if the file does not exist
+    # pace the requests to what the site accepts, the search pages and the
+    # property pages share one budget
+    limiter = RateLimiter(RATE, max_rate=MAX_RATE)
+
+    # collect the property links if the file does not exist. This still pages
+    # through the whole search history once a day; only the property pages
+    # below are limited to the new and changed listings
     if not os.path.exists(property_links_file):
-        property_links = collect_property_links(base_url, min_area, max_area, step)
+        property_links = collect_property_links(base_url, min_area, max_area, step, limiter=limiter)
         df_links = pd.DataFrame(property_links, columns=['url'])
         save_to_parquet(df_links, property_links_file)
     else:
@@ -43,40 +72,91 @@ def main(location_ids="location_ids%5B%5D=17860"):
 
     # Step 2: Collect the data from the property links
     # Create cache file in the output folder
-    cache_file = f'data/properties/raw/hemnet_properties_cache_{date}.parquet'
+    cache_file = f'data/properties/raw/hemnet_properties_cache_{date}.jsonl'
     
-    property_data_cache = load_parquet(cache_file)
+    property_data_cache = ScrapeCache(cache_file, key='url')
+
+    # only new listings and the ones due for a refresh are fetched, known
+    # ones conditionally when the site gave validators
+    registry = ListingRegistry(REGISTRY_FILE)
+    pending = registry.pending(df_links['url'])
+    logging.info(f"{len(pending)} of {len(df_links)} listings are new or due for a refresh, "
+                 f"{len(registry)} in the registry")
+
+    # record the responses as fixtures for the local stand-in
+    fixture_store = FixtureStore(record_dir) if record_dir else None
 
-    for index, row in df_links.iterrows():
+    for url in pending:
         try:
-            url = row['url']
-            
-            if not property_data_cache.empty and url in property_data_cache['url'].values:
+            if url in property_data_cache:
                 logging.info(f"Skipping already scraped URL: {url}")
                 continue
 
-            r = session.get(url)
+            limiter.acquire()
+            r = session.get(url.replace(HEMNET_URL, HEMNET_BASE_URL, 1),
+                            headers=registry.conditional_headers(url))
+            if r.status_code == 304:
+                limiter.observe(r.status_code, r.headers)
+                registry.record(url, headers=r.headers)
+                logging.info(f"Not modified: {url}")
+                continue
+            # a page without __NEXT_DATA__ may be a captcha
+            limiter.observe(r.status_code, r.headers,
+                            r.content if b'__NEXT_DATA__' not in r.content else None)
+            r.raise_for_status()
+            if fixture_store is not None:
+                fixture_store.save('GET', url, b'', r.status_code, r.headers, r.content)
             data = parse_html(r.html.html)
+
+            # only new and changed listings go to the day's data, and are
+            # recorded in the registry once it is saved
+            if not registry.changed(url, data):
+                registry.record(url, data, r.headers)
+                logging.info(f"Unchanged: {url}")
+                continue
+            registry.stage(url, data, r.headers)
             # add the url to the data
             data['url'] = url
             
-            property_data_cache = pd.concat([property_data_cache, pd.DataFrame([data])], ignore_index=True)
-            # save the cache to the file
-            save_to_parquet(property_data_cache, cache_file)
-            logging.info(f"Data collected for {url}")
-            # sleep for between 5 and 10 seconds
-            time.sleep(5 + 5 * random.random())
+            # append the data to the cache file
+            property_data_cache.append(data)
+            logging.info(f"Data collected for {url} ({limiter.metrics()['rate'] * 60:.1f} requests a minute)")
         except Exception as e:
             logging.error(f"Error collecting data for {url}: {e}")
 
-    # Step 2: Convert the list of dictionaries into a DataFrame
-    df_properties = pd.DataFrame(property_data_cache)
-
-    # Step 3: Save the DataFrame to a Parquet file with the date
-    save_to_parquet(df_properties, f'data/properties/raw/hemnet_properties_{date}_final.parquet')
+    # Step 3: Compact the cache into a Parquet file with the date
+    final_file = f'data/properties/raw/hemnet_properties_{date}_final.parquet'
+    if property_data_cache.compact(final_file) == 0:
+        logging.info("No new or changed listings today")
+        registry.close()
+        return
     # Write a message to the log
-    logging.info(f"Data saved to data/properties/raw/hemnet_properties_{date}.parquet")
+    logging.info(f"Data saved to {final_file}")
+
+    # Step 4: Add the day's data to the dataset partitioned by scrape date,
+    # so history can be read with load_parquet instead of globbing files,
+    # e.g. load_parquet(DATASET_DIR, schema=dataset_schema(DATASET_DIR))
+    parquet_file = pq.ParquetFile(final_file)
+    schema = parquet_file.schema_arrow.append(pa.field('scraped', pa.string()))
+    # one schema for every day, so the dataset can be read as a whole
+    previous_schema = dataset_schema(DATASET_DIR)
+    if previous_schema is not None:
+        schema = pa.unify_schemas([previous_schema, schema], promote_options='permissive')
+    batches = (
+        conform_batch(batch.append_column('scraped', pa.array([date] * batch.num_rows, pa.string())), schema)
+        for batch in parquet_file.iter_batches()
+    )
+    # a re-run of the same day replaces its partition, with no stale part files left
+    shutil.rmtree(os.path.join(DATASET_DIR, f'scraped={date}'), ignore_errors=True)
+    write_dataset(batches, DATASET_DIR, schema, ['scraped'],
+                  basename_template=f'hemnet_properties_{date}-{{i}}.parquet')
+
+    # the day's data is saved, the listings in it count as fetched from now on
+    saved = pq.read_table(final_file, columns=['url'])['url'].to_pylist()
+    logging.info(f"Recorded {registry.commit(saved)} listings in the registry")
+    registry.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # location ids to scrape, e.g. python src/01-scrape-housing-prices.py 17860 <id> ...
+    main(sys.argv[1:] or ("17860",))
\ No newline at end of file
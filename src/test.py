@@ -3,11 +3,16 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 import json
 import time
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.chrome.options import Options
 from seleniumwire import webdriver
 from io import BytesIO
 import gzip
+import os
+import sys
+
+# The cached chromedriver path is shared with the scraper in properties/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'properties'))
+from driver_factory import chromedriver_path
 
 # Set up the webdriver (adjust path to your chromedriver if needed)
 def setup_driver():
@@ -18,8 +23,8 @@ def setup_driver():
     chrome_options.add_argument("--headless") 
     chrome_options.add_argument("--no-sandbox")
     
-    # Initialize WebDriver using ChromeDriverManager
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+    # Initialize WebDriver with the chromedriver resolved once by ChromeDriverManager
+    driver = webdriver.Chrome(service=Service(chromedriver_path()), options=chrome_options)
     return driver
 
 # Set up the driver
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from utils.storage import ScrapeCache, infer_schema
+
+
+def test_infer_schema_keeps_keys_of_every_record():
+    schema = infer_schema([{'url': 'a', 'x': None}, {'url': 'b', 'y': 's'}, {'url': 'c', 'x': 1.5}])
+    assert schema.names == ['url', 'x', 'y']
+    assert str(schema.field('x').type) == 'double'
+    assert str(schema.field('y').type) == 'string'
+
+
+def test_compact_writes_columns_first_seen_in_later_records(tmp_path):
+    cache = ScrapeCache(str(tmp_path / 'cache.jsonl'))
+    for record in [{'url': 'a', 'price': None}, {'url': 'b', 'y': 's'},
+                   {'url': 'c', 'price': '1 000 kr', 'z': 2}, {'url': 'a', 'price': 'dup'}]:
+        cache.append(record)
+    output = str(tmp_path / 'out.parquet')
+    assert cache.compact(output, batch_size=2) == 3
+    rows = pq.read_table(output).to_pylist()
+    assert rows == [
+        {'url': 'a', 'price': None, 'y': None, 'z': None},
+        {'url': 'b', 'price': None, 'y': 's', 'z': None},
+        {'url': 'c', 'price': '1 000 kr', 'y': None, 'z': 2},
+    ]
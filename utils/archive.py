@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import zstandard
+
+try:
+    from files import read_jsonl, truncate_torn_line, write_atomic
+except ImportError:
+    # Imported as utils.archive from the repository root
+    from utils.files import read_jsonl, truncate_torn_line, write_atomic
+
+# Kinds of payloads kept per listing
+NEXT_DATA = 'next_data'
+SALE_MAP = 'sale_map'
+
+
+def object_path(directory, digest):
+    return os.path.join(directory, 'objects', digest[:2], digest + '.zst')
+
+
+def load_object(directory, digest):
+    """
+    Returns the payload with the given hash from an archive directory. Needs
+    no open PageArchive, so worker processes can read payloads directly.
+    """
+    with open(object_path(directory, digest), 'rb') as f:
+        return zstandard.ZstdDecompressor().decompress(f.read())
+
+
+class PageArchive:
+    """
+    Archive of the raw payloads fetched for each listing, so the Parquet
+    output can be rebuilt without going back to the site. Payloads are
+    stored zstd-compressed under objects/, addressed by the sha256 of their
+    content so identical payloads are stored once. index.jsonl maps listing
+    IDs to the hashes of their payloads, one {"listing_id", "kind", "hash",
+    "url", "fetched"} per line; the last line of a listing and kind wins.
+    """
+
+    def __init__(self, directory, level=10):
+        self.directory = directory
+        self.index_file = os.path.join(directory, 'index.jsonl')
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.index = {}
+        for entry in read_jsonl(self.index_file):
+            self.index.setdefault(entry['listing_id'], {})[entry['kind']] = entry['hash']
+        truncate_torn_line(self.index_file)
+        self._index = open(self.index_file, 'a', encoding='utf-8')
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._lock = threading.Lock()
+
+    def put(self, listing_id, kind, content, url=None):
+        """
+        Stores a payload of a listing and returns its hash. A payload with
+        the same content is only written once.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()
+        path = object_path(self.directory, digest)
+        if not os.path.exists(path):
+            with self._lock:
+                compressed = self._compressor.compress(content)
+            write_atomic(path, compressed)
+
+        entry = {'listing_id': listing_id, 'kind': kind, 'hash': digest, 'url': url, 'fetched': time.time()}
+        with self._lock:
+            if self.index.get(listing_id, {}).get(kind) != digest:
+                self._index.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                self._index.flush()
+                self.index.setdefault(listing_id, {})[kind] = digest
+        return digest
+
+    def get(self, digest):
+        """Returns the payload with the given hash."""
+        return load_object(self.directory, digest)
+
+    def load(self, listing_id, kind):
+        """Returns the latest payload of a kind for a listing, or None."""
+        digest = self.index.get(listing_id, {}).get(kind)
+        return self.get(digest) if digest is not None else None
+
+    def listings(self, kind=NEXT_DATA):
+        """Returns the IDs of the listings with a payload of the given kind."""
+        return [listing_id for listing_id, kinds in self.index.items() if kind in kinds]
+
+    def __contains__(self, listing_id):
+        return listing_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if not self._index.closed:
+            self._index.close()
@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+
+def read_jsonl(filename):
+    """Yield the records of a JSON lines file, skipping a torn last line."""
+    if not os.path.exists(filename):
+        return
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                return
+            yield json.loads(line)
+
+
+def truncate_torn_line(filename):
+    """
+    Cuts off the partial last line a crash in the middle of a write leaves in
+    a JSON lines file, so the next record starts on a line of its own.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb+') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+
+
+def write_atomic(filename, data, fsync=False):
+    """
+    Writes `data`, bytes or text, to a temporary file next to `filename` and
+    renames it over `filename`, so a crash never leaves a half-written file
+    behind. The temporary file is named after the writing process and
+    thread, so concurrent writers of the same file don't clobber each
+    other's.
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import zstandard
+
+try:
+    from files import write_atomic
+    from ratelimit import RateLimiter
+except ImportError:
+    # Imported as utils.fixtures from the repository root
+    from utils.files import write_atomic
+    from utils.ratelimit import RateLimiter
+
+# Headers that describe the transfer rather than the content; the recorded
+# content is always stored decoded
+SKIPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+
+def fixture_key(method, url, body=b''):
+    """
+    Key of a recorded response: the method, path and query of the request,
+    plus the body for POST requests such as GraphQL calls. The host is left
+    out so fixtures recorded from hemnet.se match requests to the stand-in.
+    """
+    parts = urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    digest = hashlib.sha256(f'{method.upper()} {target}\n'.encode('utf-8'))
+    if body:
+        digest.update(body if isinstance(body, bytes) else body.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FixtureStore:
+    """
+    Recorded HTTP responses, one zstd-compressed file per request. Each file
+    holds a JSON header line (request, status and headers) followed by the
+    decoded response content.
+    """
+
+    def __init__(self, directory, level=10):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.zst')
+
+    def save(self, method, url, body, status, headers, content):
+        """Records a response."""
+        header = {
+            'method': method.upper(),
+            'url': url,
+            'status': status,
+            'headers': {
+                key: value for key, value in dict(headers).items()
+                if key.lower() not in SKIPPED_HEADERS
+            },
+        }
+        data = json.dumps(header, ensure_ascii=False).encode('utf-8') + b'\n' + (content or b'')
+        path = self._path(fixture_key(method, url, body))
+        with self._lock:
+            compressed = self._compressor.compress(data)
+        write_atomic(path, compressed)
+
+    def load(self, method, url, body=b''):
+        """
+        Returns the recorded (status, headers, content) of a request, or None.
+        """
+        path = self._path(fixture_key(method, url, body))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = self._decompressor.decompress(f.read())
+        header, content = data.split(b'\n', 1)
+        header = json.loads(header)
+        return header['status'], header['headers'], content
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.zst'))
+
+
+def make_handler(store, latency=(0, 0), error_rate=0, limiter=None):
+    """
+    Returns a request handler that replays the store's responses with
+    the given latency range in seconds, rate of 503 errors and 429 throttling.
+    """
+
+    class StandInHandler(BaseHTTPRequestHandler):
+
+        def _replay(self, body=b''):
+            if limiter is not None:
+                wait = limiter.try_acquire()
+                if wait:
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(max(1, round(wait))))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            time.sleep(random.uniform(*latency))
+
+            if random.random() < error_rate:
+                self.send_error(503)
+                return
+
+            fixture = store.load(self.command, self.path, body)
+            if fixture is None:
+                self.send_error(404, 'No fixture recorded for this request')
+                return
+            status, headers, content = fixture
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self._replay()
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self._replay(self.rfile.read(length))
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return StandInHandler
+
+
+def serve(directory, host='127.0.0.1', port=8000, latency=(0, 0), error_rate=0, rate=None, burst=5):
+    """
+    Runs a local stand-in for hemnet.se that replays recorded fixtures.
+    Point the scrapers at it with HEMNET_BASE_URL=http://<host>:<port>.
+    """
+    store = FixtureStore(directory)
+    # A fixed budget, the stand-in does not adapt to its clients
+    limiter = RateLimiter(rate, burst) if rate else None
+    handler = make_handler(store, latency, error_rate, limiter)
+    server = ThreadingHTTPServer((host, port), handler)
+    logging.info(f"Serving {len(store)} fixtures from {directory} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Serve recorded Hemnet fixtures.')
+    parser.add_argument('directory', help='Directory of recorded fixtures')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, nargs=2, default=(0, 0), metavar=('MIN', 'MAX'),
+                        help='Range of the latency added to each response, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of requests answered with a 503 error')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Requests per second served before throttling with 429')
+    parser.add_argument('--burst', type=int, default=5,
+                        help='Number of requests allowed in a burst above --rate')
+    args = parser.parse_args()
+    serve(args.directory, args.host, args.port, tuple(args.latency), args.error_rate,
+          args.rate, args.burst)
@@ -0,0 +1,308 @@
+import functools
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Mean earth radius
+EARTH_RADIUS_KM = 6371.0088
+
+# Points distances are measured to, as (latitude, longitude)
+POINTS_OF_INTEREST = {
+    'northvolt_ett': (64.7367, 21.0583),
+    'skelleftea_centre': (64.7507, 20.9528),
+}
+
+# Cell coordinates are packed into one int64 key, 18 bits per axis, which
+# bounds how small the cells can be
+_KEY_BITS = 18
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+MIN_CELL_KM = EARTH_RADIUS_KM / (1 << (_KEY_BITS - 2))
+
+# Largest number of distances computed at once
+BLOCK_SIZE = 1 << 22
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Returns the great-circle distance in km between points given in degrees.
+    Takes scalars or arrays, which are broadcast against each other.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _column(df, name):
+    return pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+
+def _days(dates):
+    """Returns dates as days since the epoch, NaN where missing."""
+    dates = pd.to_datetime(pd.Series(dates).reset_index(drop=True), errors='coerce')
+    return (dates - pd.Timestamp(0)).dt.days.to_numpy(dtype=float, na_value=np.nan)
+
+
+def distance_features(df, points=None, latitude='latitude', longitude='longitude'):
+    """
+    Returns a DataFrame with the distance in km from every row of `df` to each
+    point of interest, in distance_<name>_km columns aligned with `df`.
+    Points default to POINTS_OF_INTEREST.
+    """
+    points = POINTS_OF_INTEREST if points is None else points
+    lat, lon = _column(df, latitude), _column(df, longitude)
+    return pd.DataFrame(
+        {f'distance_{name}_km': haversine(lat, lon, *point) for name, point in points.items()},
+        index=df.index,
+    )
+
+
+def _cartesian(latitude, longitude):
+    """Returns earth-centred coordinates in km of points given in degrees."""
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    return EARTH_RADIUS_KM * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _chord(distance_km):
+    """Returns the straight-line length of a great-circle distance."""
+    return 2 * EARTH_RADIUS_KM * np.sin(min(distance_km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+
+def _arc(chord_km):
+    """Returns the great-circle distance of a straight-line length."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord_km / (2 * EARTH_RADIUS_KM), 1))
+
+
+def _cell_keys(cells):
+    cells = cells + _KEY_OFFSET
+    return (cells[..., 0] << (2 * _KEY_BITS)) | (cells[..., 1] << _KEY_BITS) | cells[..., 2]
+
+
+@functools.lru_cache(maxsize=None)
+def _offsets(ring):
+    steps = np.arange(-ring, ring + 1)
+    return np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def _smallest(distances, k):
+    """
+    Returns the columns and values of the `k` smallest distances of every
+    row, in increasing order and padded with inf when a row has fewer.
+    """
+    if distances.shape[1] > k:
+        columns = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    values = np.take_along_axis(distances, columns, axis=1)
+    order = np.argsort(values, axis=1)
+    columns = np.take_along_axis(columns, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    if values.shape[1] < k:
+        padding = k - values.shape[1]
+        columns = np.pad(columns, ((0, 0), (0, padding)))
+        values = np.pad(values, ((0, 0), (0, padding)), constant_values=np.inf)
+    return columns, values
+
+
+class SpatialIndex:
+    """
+    Grid index over points on the earth's surface. Points are bucketed into
+    cubes of `cell_km` a side in earth-centred coordinates, so a query only
+    measures the distance to the points in the cubes around it, and queries
+    over all points run one cube at a time as array operations.
+
+    Points with missing coordinates are left out. Results refer to points by
+    their position in the arrays the index was built from.
+    """
+
+    def __init__(self, latitude, longitude, cell_km=2.0):
+        if cell_km < MIN_CELL_KM:
+            raise ValueError(f"cell_km must be at least {MIN_CELL_KM:.3f}")
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        valid = ~(np.isnan(latitude) | np.isnan(longitude))
+        self.cell_km = cell_km
+        self.size = len(latitude)
+
+        xyz = _cartesian(latitude[valid], longitude[valid])
+        cells = np.floor(xyz / cell_km).astype(np.int64)
+        keys = _cell_keys(cells)
+        order = np.argsort(keys, kind='stable')
+        # Points sorted by cell, with the range of every occupied cell
+        self.positions = np.flatnonzero(valid)[order]
+        self.xyz = xyz[order]
+        self.cells = cells[order]
+        self.keys, self.starts = np.unique(keys[order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(order))
+        self._all = np.arange(len(order))
+        self._cell_min = cells.min(axis=0) if len(cells) else None
+        self._cell_max = cells.max(axis=0) if len(cells) else None
+
+    @classmethod
+    def from_frame(cls, df, latitude='latitude', longitude='longitude', cell_km=2.0):
+        return cls(_column(df, latitude), _column(df, longitude), cell_km)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _ring(self, radius_km):
+        """Returns how many cells around a point hold everything within `radius_km`."""
+        return max(1, int(np.ceil(_chord(radius_km) / self.cell_km)))
+
+    def _candidates(self, cell, ring):
+        """
+        Returns the points in the cubes up to `ring` cells from `cell`, and
+        whether they are all the indexed points.
+        """
+        if ((2 * ring + 1) ** 3 >= len(self.keys)
+                or (np.all(self._cell_min >= cell - ring) and np.all(self._cell_max <= cell + ring))):
+            return self._all, True
+        keys = _cell_keys(cell + _offsets(ring))
+        slots = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        slots = slots[self.keys[slots] == keys]
+        lengths = self.ends[slots] - self.starts[slots]
+        # Concatenated ranges starts[slot]:ends[slot]
+        shifts = np.repeat(self.starts[slots] - np.cumsum(lengths) + lengths, lengths)
+        return shifts + np.arange(lengths.sum()), False
+
+    def _squared_chords(self, xyz, candidates):
+        """
+        Returns the squared straight-line distances from points to the
+        candidates, which order them like great-circle distances but need no
+        trigonometry: |a - b|^2 = 2R^2 - 2 a.b as one matrix product.
+        """
+        return np.maximum(2 * EARTH_RADIUS_KM ** 2 - 2 * xyz @ self.xyz[candidates].T, 0)
+
+    def within(self, latitude, longitude, radius_km):
+        """
+        Returns the positions of the points within `radius_km` of a location
+        and their distances in km, nearest first.
+        """
+        if not len(self):
+            return np.empty(0, np.int64), np.empty(0)
+        xyz = _cartesian([latitude], [longitude])
+        cell = np.floor(xyz[0] / self.cell_km).astype(np.int64)
+        candidates, _ = self._candidates(cell, self._ring(radius_km))
+        distances = _arc(np.sqrt(self._squared_chords(xyz, candidates)[0]))
+        found = distances <= radius_km
+        order = np.argsort(distances[found])
+        return self.positions[candidates[found][order]], distances[found][order]
+
+    def nearest(self, latitude, longitude, k):
+        """
+        Returns the positions of the `k` points nearest to a location and
+        their distances in km, nearest first.
+        """
+        if not len(self):
+            return np.empty(0, np.int64), np.empty(0)
+        xyz = _cartesian([latitude], [longitude])
+        cell = np.floor(xyz[0] / self.cell_km).astype(np.int64)
+        ring = 1
+        while True:
+            candidates, complete = self._candidates(cell, ring)
+            columns, values = _smallest(self._squared_chords(xyz, candidates), k)
+            # Everything within ring * cell_km of the location is in the cubes searched
+            if complete or values[0, -1] <= (ring * self.cell_km) ** 2:
+                found = np.isfinite(values[0])
+                return self.positions[candidates[columns[0][found]]], _arc(np.sqrt(values[0][found]))
+            ring *= 2
+
+    def neighbours(self, k, radius_km=None, before=None):
+        """
+        Finds the `k` nearest other points of every indexed point, only
+        within `radius_km` if given. With `before`, dates aligned with the
+        points the index was built from, only points dated strictly earlier
+        are neighbours, as for comparable sales known at the time of a sale.
+
+        Returns two arrays of shape (n, k) aligned with the points the index
+        was built from: the positions of the neighbours, -1 where fewer were
+        found, and their distances in km, NaN where fewer were found.
+        """
+        positions = np.full((self.size, k), -1, dtype=np.int64)
+        distances = np.full((self.size, k), np.nan)
+        dates = _days(before)[self.positions] if before is not None else None
+        first_ring = self._ring(radius_km) if radius_km is not None else 1
+        limit = _chord(radius_km) ** 2 if radius_km is not None else np.inf
+
+        for start, end in zip(self.starts, self.ends):
+            pending = np.arange(start, end)
+            ring = first_ring
+            while len(pending):
+                candidates, complete = self._candidates(self.cells[start], ring)
+                unresolved = []
+                step = max(1, BLOCK_SIZE // max(1, len(candidates)))
+                for i in range(0, len(pending), step):
+                    rows = pending[i:i + step]
+                    block = self._squared_chords(self.xyz[rows], candidates)
+                    block[candidates[None, :] == rows[:, None]] = np.inf
+                    if dates is not None:
+                        block[~(dates[candidates][None, :] < dates[rows][:, None])] = np.inf
+                    block[block > limit] = np.inf
+                    columns, values = _smallest(block, k)
+                    # A row is settled once its k-th neighbour is nearer than
+                    # anything outside the cubes searched
+                    settled = np.full(len(rows), complete or radius_km is not None)
+                    settled |= values[:, -1] <= (ring * self.cell_km) ** 2
+                    found = np.isfinite(values) & settled[:, None]
+                    targets = self.positions[rows[settled]]
+                    positions[targets] = np.where(found, self.positions[candidates[columns]], -1)[settled]
+                    distances[targets] = np.where(found, _arc(np.sqrt(values)), np.nan)[settled]
+                    unresolved.append(rows[~settled])
+                pending = np.concatenate(unresolved)
+                ring *= 2
+        return positions, distances
+
+    def count_within(self, radius_km, before=None):
+        """
+        Returns the number of other points within `radius_km` of every
+        indexed point, aligned with the points the index was built from and
+        NaN for points with missing coordinates. With `before`, only points
+        dated strictly earlier are counted.
+        """
+        counts = np.full(self.size, np.nan)
+        dates = _days(before)[self.positions] if before is not None else None
+        ring = self._ring(radius_km)
+        limit = _chord(radius_km) ** 2
+        for start, end in zip(self.starts, self.ends):
+            candidates, _ = self._candidates(self.cells[start], ring)
+            step = max(1, BLOCK_SIZE // max(1, len(candidates)))
+            for i in range(start, end, step):
+                rows = np.arange(i, min(i + step, end))
+                block = self._squared_chords(self.xyz[rows], candidates) <= limit
+                block &= candidates[None, :] != rows[:, None]
+                if dates is not None:
+                    block &= dates[candidates][None, :] < dates[rows][:, None]
+                counts[self.positions[rows]] = block.sum(axis=1)
+        return counts
+
+
+def comparable_sales(df, k=10, radius_km=None, value='squareMeterSellingPrice', date='soldAt',
+                     latitude='latitude', longitude='longitude', cell_km=2.0):
+    """
+    Returns features of the `k` nearest earlier sales of every listing in
+    `df`, within `radius_km` if given: how many were found, their mean
+    distance in km and the median of their `value`, aligned with `df`.
+    Pass date=None to compare with all other sales regardless of date.
+    """
+    index = SpatialIndex.from_frame(df, latitude, longitude, cell_km)
+    positions, distances = index.neighbours(k, radius_km, df[date] if date else None)
+    # Position -1 picks the NaN appended at the end
+    values = np.append(_column(df, value), np.nan)[positions]
+    with warnings.catch_warnings():
+        # Listings without comparables give all-NaN rows
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return pd.DataFrame({
+            'comps_count': (positions >= 0).sum(axis=1),
+            'comps_distance_km': np.nanmean(distances, axis=1),
+            f'comps_median_{value}': np.nanmedian(values, axis=1),
+        }, index=df.index)
+
+
+def sales_within(df, radius_km, date='soldAt', latitude='latitude', longitude='longitude', cell_km=2.0):
+    """
+    Returns the number of earlier sales within `radius_km` of every listing
+    in `df`, a measure of local market activity, aligned with `df`.
+    """
+    index = SpatialIndex.from_frame(df, latitude, longitude, cell_km)
+    counts = index.count_within(radius_km, df[date] if date else None)
+    return pd.Series(counts, index=df.index, name=f'sales_within_{radius_km:g}km')
@@ -0,0 +1,252 @@
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from files import write_atomic
+except ImportError:
+    # Imported as utils.metrics from the repository root
+    from utils.files import write_atomic
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their count, sum and max."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket holding it."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of a run, keyed by name and
+    labels. Collectors registered with `add_collector` are called before
+    every export to update gauges such as memory use.
+    """
+
+    def __init__(self):
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._exporter = None
+        self._stop = threading.Event()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[_key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def time(self, stage):
+        """Records the seconds spent in the block in the stage_seconds histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            collector(self)
+
+    def summary(self):
+        """Returns the metrics as a dictionary that can be written as JSON."""
+        self.collect()
+        with self._lock:
+            return {
+                'duration': time.time() - self.started,
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'gauges': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name, 'labels': dict(labels),
+                        'count': histogram.count, 'sum': histogram.sum,
+                        'mean': histogram.sum / histogram.count if histogram.count else 0,
+                        'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95),
+                        'max': histogram.max,
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        self.collect()
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}_total{_format_labels(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_summary(self, filename):
+        write_atomic(filename, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, filename):
+        write_atomic(filename, self.to_prometheus())
+
+    def start_exporter(self, filename, interval=15):
+        """Writes the metrics to `filename` in Prometheus format every `interval` seconds."""
+        def export():
+            while not self._stop.wait(interval):
+                self.write_prometheus(filename)
+        self._exporter = threading.Thread(target=export, daemon=True)
+        self._exporter.start()
+
+    def stop_exporter(self):
+        if self._exporter is not None:
+            self._stop.set()
+            self._exporter.join()
+            self._exporter = None
+
+
+def process_rss(pid):
+    """
+    Returns the resident memory in bytes of a single process, read from
+    /proc, or None where it is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_tree_rss(pid):
+    """
+    Returns the resident memory in bytes of a process and all its
+    descendants, read from /proc, or None where /proc is not available.
+    """
+    if not os.path.exists('/proc'):
+        return None
+    children = collections.defaultdict(list)
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may hold spaces, the fields after it don't
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+        rss[int(entry)] = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children[current])
+    return total
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every `interval` seconds and counts
+    them, written as collapsed stacks (one "frame;frame;... count" per line)
+    that flame graph tools read.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self, filename):
+        """Stops sampling and writes the collapsed stacks to `filename`."""
+        self._stop.set()
+        self._thread.join()
+        write_atomic(filename, ''.join(
+            f'{stack} {count}\n' for stack, count in self.samples.most_common()
+        ))
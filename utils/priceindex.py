@@ -0,0 +1,281 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Covariates of the hedonic regression and the transform applied to each.
+# Houses have no fee, so a missing fee counts as none.
+HEDONIC_COVARIATES = {
+    'livingArea': np.log,
+    'numberOfRooms': lambda rooms: rooms,
+    'fee': lambda fee: np.nan_to_num(fee / 1000),
+    'constructionYear': lambda year: (year - 1970) / 10,
+    'distance_northvolt_ett_km': lambda distance: distance,
+}
+
+# Added to the diagonal so windows with empty quarters can still be solved
+RIDGE = 1e-8
+
+
+def unit_key(df):
+    """
+    Returns the key identifying the same home across sales: the normalized
+    street address, the housing cooperative, and the living area and rooms,
+    which tell apart apartments sharing an address.
+    """
+    def text(column):
+        return df[column].astype('string').fillna('').str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
+
+    return (df['municipality'].astype('string').fillna('') + '|' + text('streetAddress') + '|'
+            + text('housingCooperative') + '|'
+            + pd.to_numeric(df['livingArea'], errors='coerce').round().astype('string').fillna('') + '|'
+            + pd.to_numeric(df['numberOfRooms'], errors='coerce').astype('string').fillna(''))
+
+
+class PriceIndex:
+    """
+    Quarterly house price index, estimated two ways from the same sales:
+
+    - hedonic: log price regressed on HEDONIC_COVARIATES and quarter dummies
+      in rolling windows of `window` quarters, chained by the movement of the
+      last quarter of each window;
+    - repeat sales: changes in log price between consecutive sales of the
+      same home regressed on quarter dummies (Bailey, Muth and Nourse).
+
+    Both regressions are kept as normal equations summed per quarter, so
+    `add` only adds the new sales to them, and only the windows holding a
+    quarter with new sales are solved again, as one batch.
+    """
+
+    def __init__(self, window=8, covariates=None, min_sales=10):
+        self.window = window
+        self.covariates = list(covariates or HEDONIC_COVARIATES)
+        self.min_sales = min_sales
+        size = len(self.covariates) + 1
+        # Ordinal of the first quarter, the arrays below hold one row per quarter from it
+        self.first = None
+        self.zz = np.zeros((0, size, size))
+        self.zy = np.zeros((0, size))
+        self.pair_xx = np.zeros((0, 0))
+        self.pair_xy = np.zeros(0)
+        self.sales = pd.DataFrame({
+            'id': pd.Series(dtype='string'), 'key': pd.Series(dtype='string'),
+            'quarter': pd.Series(dtype='int64'), 'soldAt': pd.Series(dtype='datetime64[ns]'),
+            'logPrice': pd.Series(dtype='float64'),
+        })
+        # Coefficients of every solved window by the ordinal of its first quarter
+        self.windows = {}
+        self._stale = set()
+
+    def __len__(self):
+        return len(self.sales)
+
+    @property
+    def last_sold(self):
+        return self.sales['soldAt'].max() if len(self.sales) else None
+
+    def _extend(self, quarters):
+        """Grows the per-quarter arrays to hold the given quarter ordinals."""
+        first = min(quarters.min(), self.first if self.first is not None else quarters.min())
+        last = max(quarters.max(), self.first + len(self.zz) - 1 if self.first is not None else quarters.max())
+        before = self.first - first if self.first is not None else 0
+        after = last - first + 1 - before - len(self.zz)
+        self.zz = np.pad(self.zz, ((before, after), (0, 0), (0, 0)))
+        self.zy = np.pad(self.zy, ((before, after), (0, 0)))
+        self.pair_xx = np.pad(self.pair_xx, ((before, after), (before, after)))
+        self.pair_xy = np.pad(self.pair_xy, (before, after))
+        self.first = first
+
+    def _pair_moments(self, sales):
+        """Returns the normal equations of the repeat sales among `sales`."""
+        sales = sales.sort_values(['key', 'soldAt', 'id'])
+        keys = sales['key'].to_numpy()
+        quarters = sales['quarter'].to_numpy() - self.first
+        same = keys[1:] == keys[:-1]
+        before, after = quarters[:-1][same], quarters[1:][same]
+        change = np.diff(sales['logPrice'].to_numpy())[same]
+        # Sales in the same quarter say nothing about the index
+        moved = before != after
+        before, after, change = before[moved], after[moved], change[moved]
+
+        xx = np.zeros_like(self.pair_xx)
+        xy = np.zeros_like(self.pair_xy)
+        np.add.at(xx, (before, before), 1)
+        np.add.at(xx, (after, after), 1)
+        np.add.at(xx, (before, after), -1)
+        np.add.at(xx, (after, before), -1)
+        np.add.at(xy, before, -change)
+        np.add.at(xy, after, change)
+        return xx, xy
+
+    def add(self, df):
+        """
+        Adds the sold listings of a DataFrame, skipping listings already
+        added and those without a price or sale date. Sales missing a
+        covariate only count towards the repeat sales index.
+        Returns the number of sales added.
+        """
+        price = pd.to_numeric(df['sellingPrice'], errors='coerce')
+        sold = pd.to_datetime(df['soldAt'], errors='coerce')
+        keep = (price > 0) & sold.notna() & ~df['id'].isin(self.sales['id'])
+        df, price, sold = df[keep], price[keep], sold[keep]
+        df = df[~df['id'].duplicated(keep='last')]
+        if df.empty:
+            return 0
+        price, sold = price[df.index], sold[df.index]
+
+        new = pd.DataFrame({
+            'id': df['id'].astype('string'),
+            'key': unit_key(df),
+            'quarter': pd.PeriodIndex(sold, freq='Q').asi8,
+            'soldAt': sold.astype('datetime64[ns]'),
+            'logPrice': np.log(price.to_numpy(dtype=float)),
+        }).reset_index(drop=True)
+        self._extend(new['quarter'].to_numpy())
+
+        # Hedonic normal equations of the quarter of each complete sale
+        x = np.column_stack([
+            HEDONIC_COVARIATES[name](pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=float, na_value=np.nan))
+            for name in self.covariates
+        ])
+        z = np.column_stack([np.ones(len(x)), x])
+        complete = np.isfinite(z).all(axis=1)
+        rows = new['quarter'].to_numpy()[complete] - self.first
+        z, y = z[complete], new['logPrice'].to_numpy()[complete]
+        np.add.at(self.zz, rows, z[:, :, None] * z[:, None, :])
+        np.add.at(self.zy, rows, z * y[:, None])
+
+        # Only the pairs of homes sold again change
+        previous = self.sales[self.sales['key'].isin(new['key'])]
+        old_xx, old_xy = self._pair_moments(previous)
+        new_xx, new_xy = self._pair_moments(pd.concat([previous, new]))
+        self.pair_xx += new_xx - old_xx
+        self.pair_xy += new_xy - old_xy
+
+        self.sales = pd.concat([self.sales, new], ignore_index=True) if len(self.sales) else new
+        self._stale.update(rows + self.first)
+        logger.info(f"Added {len(new)} sales, {complete.sum()} with every hedonic covariate")
+        return len(new)
+
+    def _window_size(self):
+        return min(self.window, len(self.zz))
+
+    def _solve(self, starts):
+        """Solves the hedonic regressions of the windows starting at `starts` as one batch."""
+        size = self._window_size()
+        m = self.zz.shape[1]
+        starts = np.asarray(starts) - self.first
+        sums = np.concatenate([np.zeros((1, m, m)), np.cumsum(self.zz, axis=0)])
+        y_sums = np.concatenate([np.zeros((1, m)), np.cumsum(self.zy, axis=0)])
+        # Quarter dummies of every window but its first quarter
+        dummies = starts[:, None] + np.arange(1, size)
+
+        a = np.zeros((len(starts), m + size - 1, m + size - 1))
+        a[:, :m, :m] = sums[starts + size] - sums[starts]
+        # With a constant first covariate, zz[q, :, 0] sums the covariates of quarter q
+        cross = self.zz[dummies, :, 0]
+        a[:, m:, :m] = cross
+        a[:, :m, m:] = cross.transpose(0, 2, 1)
+        diagonal = np.arange(m, m + size - 1)
+        a[:, diagonal, diagonal] = self.zz[dummies, 0, 0]
+        a += RIDGE * np.eye(m + size - 1)
+        b = np.concatenate([y_sums[starts + size] - y_sums[starts], self.zy[dummies, 0]], axis=1)
+        return np.linalg.solve(a, b[:, :, None])[:, :, 0]
+
+    def _update_windows(self):
+        size = self._window_size()
+        if size < 2:
+            return
+        starts = set(range(self.first, self.first + len(self.zz) - size + 1))
+        if any(len(coefficients) != self.zz.shape[1] + size - 1 for coefficients in self.windows.values()):
+            self.windows = {}
+        stale = sorted(
+            start for start in starts
+            if start not in self.windows or any(start <= quarter < start + size for quarter in self._stale)
+        )
+        if stale:
+            for start, coefficients in zip(stale, self._solve(stale)):
+                self.windows[start] = coefficients
+            logger.info(f"Re-estimated {len(stale)} of {len(starts)} hedonic windows")
+        self.windows = {start: self.windows[start] for start in sorted(starts)}
+        self._stale = set()
+
+    def hedonic(self):
+        """Returns the chained log hedonic index of every quarter, NaN where it is too thin."""
+        self._update_windows()
+        counts = self.zz[:, 0, 0]
+        log_index = np.full(len(self.zz), np.nan)
+        size = self._window_size()
+        m = self.zz.shape[1]
+        for i, (start, coefficients) in enumerate(self.windows.items()):
+            offset = start - self.first
+            deltas = np.concatenate([[0.0], coefficients[m:]])
+            quarters = np.arange(offset, offset + size)
+            if i == 0:
+                log_index[quarters] = np.where(counts[quarters] >= self.min_sales, deltas, np.nan)
+                log_index[offset] = 0.0
+                continue
+            last = quarters[-1]
+            # Chain from the latest earlier quarter of the window with an index
+            known = np.flatnonzero(np.isfinite(log_index[quarters[:-1]]))
+            if counts[last] >= self.min_sales and len(known):
+                base = known[-1]
+                log_index[last] = log_index[offset + base] + deltas[-1] - deltas[base]
+        return log_index
+
+    def repeat_sales(self):
+        """Returns the log repeat sales index of every quarter, NaN where no pair covers it."""
+        log_index = np.full(len(self.pair_xx), np.nan)
+        covered = np.flatnonzero(np.diag(self.pair_xx) > 0)
+        if len(covered) < 2:
+            return log_index
+        base, rest = covered[0], covered[1:]
+        log_index[base] = 0.0
+        log_index[rest] = np.linalg.lstsq(self.pair_xx[np.ix_(rest, rest)], self.pair_xy[rest], rcond=None)[0]
+        return log_index
+
+    def index(self):
+        """
+        Returns both indices per quarter, based at 100 in the first quarter
+        they cover, with the number of sales in the hedonic regression and
+        of repeat sales pairs.
+        """
+        if self.first is None:
+            return pd.DataFrame(columns=['quarter', 'sales', 'pairs', 'hedonic', 'repeat_sales'])
+        quarters = pd.PeriodIndex.from_ordinals(np.arange(self.first, self.first + len(self.zz)), freq='Q')
+        return pd.DataFrame({
+            'quarter': quarters.astype(str),
+            'sales': self.zz[:, 0, 0].astype(int),
+            'pairs': np.diag(self.pair_xx).astype(int),
+            'hedonic': 100 * np.exp(self.hedonic()),
+            'repeat_sales': 100 * np.exp(self.repeat_sales()),
+        })
+
+    def save(self, directory):
+        """Saves the state to `directory`, so later runs only add new sales."""
+        os.makedirs(directory, exist_ok=True)
+        self._update_windows()
+        starts = np.array(list(self.windows), dtype=np.int64)
+        coefficients = np.array(list(self.windows.values())).reshape(len(starts), -1)
+        with open(os.path.join(directory, 'moments.npz.tmp'), 'wb') as f:
+            np.savez(f, first=self.first or 0, zz=self.zz, zy=self.zy,
+                     pair_xx=self.pair_xx, pair_xy=self.pair_xy, starts=starts, coefficients=coefficients,
+                     covariates=np.array(self.covariates), window=self.window, min_sales=self.min_sales)
+        self.sales.to_parquet(os.path.join(directory, 'sales.parquet.tmp'), index=False)
+        os.replace(os.path.join(directory, 'moments.npz.tmp'), os.path.join(directory, 'moments.npz'))
+        os.replace(os.path.join(directory, 'sales.parquet.tmp'), os.path.join(directory, 'sales.parquet'))
+
+    @classmethod
+    def load(cls, directory):
+        """Loads the state saved to `directory`."""
+        with np.load(os.path.join(directory, 'moments.npz')) as state:
+            index = cls(int(state['window']), [str(name) for name in state['covariates']], int(state['min_sales']))
+            index.first = int(state['first']) if len(state['zz']) else None
+            index.zz, index.zy = state['zz'], state['zy']
+            index.pair_xx, index.pair_xy = state['pair_xx'], state['pair_xy']
+            index.windows = dict(zip(state['starts'].tolist(), state['coefficients']))
+        index.sales = pd.read_parquet(os.path.join(directory, 'sales.parquet'))
+        return index
@@ -0,0 +1,156 @@
+import email.utils
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Responses telling us to slow down
+THROTTLE_STATUSES = {429, 503}
+
+# Markers of a captcha or bot challenge served instead of the page
+CAPTCHA_PATTERN = re.compile(rb'captcha|cf-challenge|challenge-platform|cf_chl_', re.IGNORECASE)
+
+
+def is_captcha(content):
+    """Whether a response body is a captcha or bot challenge page."""
+    if isinstance(content, str):
+        content = content.encode('utf-8', 'ignore')
+    return bool(content) and CAPTCHA_PATTERN.search(content) is not None
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait from a Retry-After header, given either as
+    seconds or as an HTTP date, or None.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket shared by every fetch path, so all requests of a
+    run draw from one budget of `rate` requests per second with bursts of up
+    to `burst`.
+
+    The rate adapts to the responses passed to `observe`: it is halved on
+    every 429/503 or captcha page, with requests paused for the Retry-After
+    time or an exponentially growing delay, and raised by `step` after every
+    `healthy_after` healthy responses until it is back at `max_rate`. The
+    delay grows until `healthy_after` responses in a row were healthy.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, max_rate=None, step=None,
+                 healthy_after=10, max_pause=300):
+        if not rate or rate <= 0:
+            raise ValueError(f"rate must be a positive number of requests per second, got {rate}")
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate or rate / 16
+        self.max_rate = max_rate or rate
+        self.step = step or self.max_rate / 10
+        self.healthy_after = healthy_after
+        self.max_pause = max_pause
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.requests = 0
+        self.throttled = 0
+        self._healthy = 0
+        self._strikes = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """
+        Takes a token without blocking. Returns 0 on success, or the seconds
+        until one is available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.requests += 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def observe(self, status, headers=None, content=None):
+        """
+        Adapts the rate to a response. Pass `content` when the expected data
+        was missing from the page, to check it for a captcha.
+        """
+        retry_after = parse_retry_after((headers or {}).get('Retry-After'))
+        if status in THROTTLE_STATUSES:
+            self._throttle(status, retry_after)
+        elif content is not None and is_captcha(content):
+            self._throttle('captcha', retry_after)
+        elif 200 <= status < 400:
+            self._recover()
+
+    def _throttle(self, reason, retry_after):
+        with self._lock:
+            self.throttled += 1
+            self._healthy = 0
+            self._strikes += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                retry_after = min(self.max_pause, 2 ** (self._strikes - 1))
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + retry_after)
+            # No burst right after the pause
+            self.tokens = 0
+            self.updated = self.paused_until
+        logger.warning(
+            f"Throttled ({reason}), pausing {retry_after:.0f}s and slowing down to "
+            f"{self.rate * 60:.1f} requests a minute"
+        )
+
+    def _recover(self):
+        with self._lock:
+            # Responses arriving during a pause were sent before it
+            if time.monotonic() < self.paused_until:
+                return
+            self._healthy += 1
+            if self._healthy < self.healthy_after:
+                return
+            # The pauses only shrink back after a run of healthy responses
+            self._strikes = 0
+            if self.rate >= self.max_rate:
+                return
+            self._healthy = 0
+            self.rate = min(self.max_rate, self.rate + self.step)
+        logger.info(f"Responses are healthy, speeding up to {self.rate * 60:.1f} requests a minute")
+
+    def metrics(self):
+        """Returns the current rate and counters of the limiter."""
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'paused': max(0.0, self.paused_until - time.monotonic()),
+            }
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Listing pages end in the numeric listing ID, e.g. ...-orkestervagen-112-3537267266547361298
+LISTING_ID_PATTERN = re.compile(r'-(\d+)/?(?:[?#].*)?$')
+
+DAY = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    listing_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    content_hash TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    first_seen REAL NOT NULL,
+    last_fetched REAL,
+    last_changed REAL,
+    fetches INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS staged (
+    listing_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched REAL NOT NULL
+)
+'''
+
+
+def listing_id_from_url(url):
+    """Returns the numeric listing ID at the end of a listing URL, or None."""
+    match = LISTING_ID_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+
+def content_hash(data):
+    """
+    Returns the sha256 of a parsed record, with its keys sorted, so the
+    same content always hashes alike.
+    """
+    content = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class RefreshPolicy:
+    """
+    Decides when a known listing is fetched again. Listings whose content
+    changed within the last `settle` seconds are checked again after
+    `recent_max_age` seconds, the others after `max_age` seconds, or never
+    if it is None. Sold listings rarely change once published, so by
+    default only fresh ones are checked again.
+    """
+
+    def __init__(self, max_age=None, recent_max_age=DAY, settle=14 * DAY):
+        self.max_age = max_age
+        self.recent_max_age = recent_max_age
+        self.settle = settle
+
+    def due(self, entry, now=None):
+        """Whether a listing with the given registry entry should be fetched."""
+        if entry is None or entry['last_fetched'] is None:
+            return True
+        now = time.time() if now is None else now
+        changed = entry['last_changed'] or entry['first_seen']
+        max_age = self.recent_max_age if now - changed < self.settle else self.max_age
+        return max_age is not None and now - entry['last_fetched'] >= max_age
+
+
+class ListingRegistry:
+    """
+    Registry of the listings fetched so far, shared by all runs, in a SQLite
+    database keyed by listing ID. Keeps the hash of each listing's content,
+    when it was last fetched and changed, and the ETag and Last-Modified
+    validators of its response, so known listings are skipped or fetched
+    conditionally according to a RefreshPolicy.
+
+    Fetches of new or changed content are `stage`d first and only recorded
+    by `commit` once their data is saved, so a run failing before that
+    fetches them again instead of taking them as unchanged.
+    """
+
+    def __init__(self, filename, policy=None):
+        self.filename = filename
+        self.policy = policy or RefreshPolicy()
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, listing_id):
+        """Returns the registry entry of a listing, or None."""
+        with self._lock:
+            return self._db.execute('SELECT * FROM listings WHERE listing_id = ?', (listing_id,)).fetchone()
+
+    def due(self, url, now=None):
+        """Whether the listing at `url` should be fetched under the refresh policy."""
+        listing_id = listing_id_from_url(url)
+        return listing_id is None or self.policy.due(self.get(listing_id), now)
+
+    def pending(self, urls, now=None):
+        """Returns the URLs due for a fetch, in their order, with one query for all of them."""
+        with self._lock:
+            entries = {row['listing_id']: row for row in self._db.execute('SELECT * FROM listings')}
+        pending = []
+        for url in urls:
+            listing_id = listing_id_from_url(url)
+            if listing_id is None or self.policy.due(entries.get(listing_id), now):
+                pending.append(url)
+        return pending
+
+    def conditional_headers(self, url):
+        """
+        Returns the If-None-Match and If-Modified-Since headers for a listing
+        fetched before with validators, so an unchanged page comes back as
+        304 Not Modified.
+        """
+        entry = self.get(listing_id_from_url(url))
+        headers = {}
+        if entry is not None and entry['content_hash'] is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def changed(self, url, data):
+        """Whether the parsed record of the listing at `url` is new or differs from the recorded one."""
+        entry = self.get(listing_id_from_url(url))
+        return entry is None or entry['content_hash'] != content_hash(data)
+
+    def _record(self, listing_id, url, digest, etag, last_modified, now):
+        entry = self._db.execute('SELECT content_hash FROM listings WHERE listing_id = ?',
+                                 (listing_id,)).fetchone()
+        if entry is None:
+            self._db.execute(
+                'INSERT INTO listings (listing_id, url, content_hash, etag, last_modified, first_seen, '
+                'last_fetched, last_changed, fetches) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)',
+                (listing_id, url, digest, etag, last_modified, now, now, now),
+            )
+            return True
+        changed = digest is not None and digest != entry['content_hash']
+        self._db.execute(
+            'UPDATE listings SET url = ?, content_hash = COALESCE(?, content_hash), '
+            'etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), last_fetched = ?, '
+            'last_changed = CASE WHEN ? THEN ? ELSE last_changed END, fetches = fetches + 1 '
+            'WHERE listing_id = ?',
+            (url, digest, etag, last_modified, now, changed, now, listing_id),
+        )
+        return changed
+
+    def record(self, url, data=None, headers=None, now=None):
+        """
+        Records a fetch of the listing at `url` that has nothing to save:
+        `data` is the parsed record, or None for a 304 Not Modified response.
+        Returns whether the content is new or changed since the last fetch.
+        """
+        listing_id = listing_id_from_url(url)
+        if listing_id is None:
+            return True
+        now = time.time() if now is None else now
+        headers = headers or {}
+        digest = content_hash(data) if data is not None else None
+        with self._lock, self._db:
+            return self._record(listing_id, url, digest, headers.get('ETag'), headers.get('Last-Modified'), now)
+
+    def stage(self, url, data, headers=None, now=None):
+        """Keeps a fetch of new or changed content until `commit` is called with its URL."""
+        listing_id = listing_id_from_url(url)
+        if listing_id is None:
+            return
+        now = time.time() if now is None else now
+        headers = headers or {}
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO staged (listing_id, url, content_hash, etag, last_modified, fetched) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (listing_id, url, content_hash(data), headers.get('ETag'), headers.get('Last-Modified'), now),
+            )
+
+    def commit(self, urls):
+        """Records the staged fetches of `urls`, once their data is saved. Returns how many were recorded."""
+        listing_ids = {listing_id_from_url(url) for url in urls}
+        committed = 0
+        with self._lock, self._db:
+            for row in self._db.execute('SELECT * FROM staged').fetchall():
+                if row['listing_id'] not in listing_ids:
+                    continue
+                self._record(row['listing_id'], row['url'], row['content_hash'], row['etag'],
+                             row['last_modified'], row['fetched'])
+                self._db.execute('DELETE FROM staged WHERE listing_id = ?', (row['listing_id'],))
+                committed += 1
+        return committed
+
+    def __contains__(self, url):
+        return self.get(listing_id_from_url(url)) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM listings').fetchone()[0]
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,236 @@
+import datetime
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Low-cardinality text columns are dictionary-encoded
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+DISTRICT = pa.struct([
+    ('id', pa.string()),
+    ('fullName', pa.string()),
+])
+
+AMENITY = pa.struct([
+    ('kind', pa.string()),
+    ('isRelevant', pa.bool_()),
+    ('isAvailable', pa.bool_()),
+])
+
+# Schema of the sold listings written by properties/main.py. Money columns
+# hold the amount in kronor.
+SOLD_LISTING_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('listingId', pa.string()),
+    ('hemnetUrl', pa.string()),
+    ('streetAddress', pa.string()),
+    ('locationName', pa.string()),
+    ('municipality', CATEGORY),
+    ('municipality_id', CATEGORY),
+    ('county', CATEGORY),
+    ('county_id', CATEGORY),
+    ('districts', pa.list_(DISTRICT)),
+    ('housingForm', CATEGORY),
+    ('housingForm_symbol', CATEGORY),
+    ('tenure', CATEGORY),
+    ('tenure_symbol', CATEGORY),
+    ('housingCooperative', pa.string()),
+    ('brokerAgency', CATEGORY),
+    ('brokerAgency_id', CATEGORY),
+    ('broker_name', pa.string()),
+    ('broker_id', pa.string()),
+    ('askingPrice', pa.int64()),
+    ('sellingPrice', pa.int64()),
+    ('priceChange', pa.int64()),
+    ('squareMeterSellingPrice', pa.int64()),
+    ('fee', pa.int64()),
+    ('runningCosts', pa.int64()),
+    ('yearlyArrendeFee', pa.int64()),
+    ('yearlyLeaseholdFee', pa.int64()),
+    ('livingArea', pa.float64()),
+    ('landArea', pa.float64()),
+    ('numberOfRooms', pa.float64()),
+    ('constructionYear', pa.int16()),
+    ('formattedFloor', pa.string()),
+    ('soldAt', pa.date32()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('relevantAmenities', pa.list_(AMENITY)),
+])
+
+# The sold listings dataset is partitioned by municipality and month of sale
+PARTITION_COLUMNS = ['municipality', 'soldMonth']
+PARTITIONED_SCHEMA = SOLD_LISTING_SCHEMA.append(pa.field('soldMonth', pa.string()))
+
+NEIGHBOUR_PANORAMA = pa.struct([
+    ('pano_id', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('elevation', pa.float32()),
+    ('heading', pa.float32()),
+])
+
+# Schema of the Street View panoramas parsed from saved Google Maps
+# photometa responses by properties/street_view.py
+STREET_VIEW_SCHEMA = pa.schema([
+    ('pano_id', pa.string()),
+    ('source', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('elevation', pa.float32()),
+    ('heading', pa.float32()),
+    ('tilt', pa.float32()),
+    ('roll', pa.float32()),
+    ('country', CATEGORY),
+    ('label', CATEGORY),
+    ('language', CATEGORY),
+    ('copyright', CATEGORY),
+    ('capture_year', pa.int16()),
+    ('capture_month', pa.int8()),
+    ('image_height', pa.int32()),
+    ('image_width', pa.int32()),
+    ('tile_height', pa.int16()),
+    ('tile_width', pa.int16()),
+    ('zoom_levels', pa.int8()),
+    ('neighbours', pa.list_(NEIGHBOUR_PANORAMA)),
+])
+
+
+def _get(value, key):
+    return value.get(key) if isinstance(value, dict) else None
+
+
+def _amount(money):
+    """Returns the amount in kronor of a Money object, or None."""
+    if not isinstance(money, dict):
+        return None
+    if money.get('amount') is not None:
+        return int(money['amount'])
+    if money.get('amountInCents') is not None:
+        return int(money['amountInCents']) // 100
+    return None
+
+
+def _number(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def _year(value):
+    value = str(value or '').strip()
+    return int(value) if value.isdigit() else None
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _name(value):
+    if isinstance(value, dict):
+        return value.get('name')
+    return value if isinstance(value, str) else None
+
+
+def listing_row(info):
+    """
+    Flattens the property information of a listing into a row of
+    SOLD_LISTING_SCHEMA.
+    """
+    return {
+        'id': info.get('id'),
+        'listingId': info.get('listingId'),
+        'hemnetUrl': info.get('hemnetUrl'),
+        'streetAddress': info.get('streetAddress'),
+        'locationName': info.get('locationName'),
+        'municipality': _get(info.get('municipality'), 'fullName'),
+        'municipality_id': _get(info.get('municipality'), 'id'),
+        'county': _get(info.get('county'), 'fullName'),
+        'county_id': _get(info.get('county'), 'id'),
+        'districts': [
+            {'id': district.get('id'), 'fullName': district.get('fullName')}
+            for district in info.get('districts') or [] if isinstance(district, dict)
+        ],
+        'housingForm': _get(info.get('housingForm'), 'name'),
+        'housingForm_symbol': _get(info.get('housingForm'), 'symbol'),
+        'tenure': _get(info.get('tenure'), 'name'),
+        'tenure_symbol': _get(info.get('tenure'), 'symbol'),
+        'housingCooperative': _name(info.get('housingCooperative')),
+        'brokerAgency': _get(info.get('brokerAgency'), 'name'),
+        'brokerAgency_id': _get(info.get('brokerAgency'), 'id'),
+        'broker_name': _get(info.get('broker'), 'name'),
+        'broker_id': _get(info.get('broker'), 'id'),
+        'askingPrice': _amount(info.get('askingPrice')),
+        'sellingPrice': _amount(info.get('sellingPrice')),
+        'priceChange': _amount(info.get('priceChange')),
+        'squareMeterSellingPrice': _amount(info.get('squareMeterSellingPrice')),
+        'fee': _amount(info.get('fee')),
+        'runningCosts': _amount(info.get('runningCosts')),
+        'yearlyArrendeFee': _amount(info.get('yearlyArrendeFee')),
+        'yearlyLeaseholdFee': _amount(info.get('yearlyLeaseholdFee')),
+        'livingArea': _number(info.get('livingArea')),
+        'landArea': _number(info.get('landArea')),
+        'numberOfRooms': _number(info.get('numberOfRooms')),
+        'constructionYear': _year(info.get('legacyConstructionYear')),
+        'formattedFloor': info.get('formattedFloor'),
+        'soldAt': _date(info.get('soldAt')),
+        'latitude': _number(info.get('latitude')),
+        'longitude': _number(info.get('longitude')),
+        'relevantAmenities': [
+            {
+                'kind': amenity.get('kind'),
+                'isRelevant': amenity.get('isRelevant'),
+                'isAvailable': amenity.get('isAvailable'),
+            }
+            for amenity in info.get('relevantAmenities') or [] if isinstance(amenity, dict)
+        ],
+    }
+
+
+# Money fields of the property information
+MONEY_FIELDS = ('askingPrice', 'sellingPrice', 'priceChange', 'squareMeterSellingPrice', 'fee',
+                'runningCosts', 'yearlyArrendeFee', 'yearlyLeaseholdFee')
+
+
+def unflatten_row(row, sep='_'):
+    """
+    Rebuilds the property information of a row flattened by
+    pandas.json_normalize, as written by earlier versions of
+    properties/main.py, so it can go through listing_row.
+    """
+    info = {}
+    for key, value in row.items():
+        if value is None:
+            continue
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        if isinstance(value, str) and value[:1] in ('[', '{'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        head, _, tail = key.partition(sep)
+        if head and tail:
+            if not isinstance(info.get(head), dict):
+                info[head] = {}
+            info[head][tail] = value
+        elif key not in info:
+            info[key] = value
+    # Money fields left flat hold the amount
+    for key in MONEY_FIELDS:
+        if isinstance(info.get(key), (int, float)):
+            info[key] = {'amount': info[key]}
+    return info
+
+
+def listings_table(records):
+    """Builds an Arrow table of SOLD_LISTING_SCHEMA from property information dictionaries."""
+    return pa.Table.from_pylist([listing_row(info) for info in records], schema=SOLD_LISTING_SCHEMA)
+
+
+def with_sold_month(batch):
+    """Adds the soldMonth (YYYY-MM) partition column to a record batch of SOLD_LISTING_SCHEMA."""
+    sold_month = pc.strftime(pc.cast(batch['soldAt'], pa.timestamp('s')), '%Y-%m')
+    return batch.append_column('soldMonth', sold_month)
@@ -1,14 +1,260 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import os
+import json
+import shutil
+import time
+
+try:
+    from files import read_jsonl, truncate_torn_line
+except ImportError:
+    # Imported as utils.storage from the repository root
+    from utils.files import read_jsonl, truncate_torn_line
 
 def save_to_parquet(df, filename):
     # Ensure the output folder exists
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     df.to_parquet(filename, index=False)
 
-def load_parquet(filename):
-    """Load a Parquet file into a DataFrame."""
-    if os.path.exists(filename):
-        return pd.read_parquet(filename)
-    else:
-        return pd.DataFrame()
\ No newline at end of file
+def load_parquet(filename, columns=None, filters=None, schema=None):
+    """
+    Load a Parquet file, or the directory of a Hive-partitioned dataset, into
+    a DataFrame. `columns` and `filters` are pushed down to the reader, so
+    partitions and row groups that cannot match are skipped. Filters are
+    (column, op, value) tuples, e.g. [('municipality', '=', 'Skellefteå kommun')],
+    or a list of such lists combined with OR.
+
+    A dataset whose files were written over time with different columns
+    should be read with its full `schema`, so columns missing from or empty
+    in some files are read with their type. Otherwise the schema of the
+    first file is used.
+    """
+    if not os.path.exists(filename):
+        return pd.DataFrame(columns=columns)
+    if schema is not None:
+        # Partition values are read as plain strings, a dictionary type
+        # would need its dictionary up front
+        schema = pa.schema([
+            field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field
+            for field in schema
+        ], metadata=schema.metadata)
+    dataset = ds.dataset(filename, schema=schema, format='parquet', partitioning='hive')
+    expression = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+def write_dataset(batches, directory, schema, partition_cols,
+                  basename_template='part-{i}.parquet', replace=False):
+    """
+    Write record batches into a Hive-partitioned Parquet dataset with one
+    directory level per partition column, e.g. municipality=.../soldMonth=...
+
+    With `replace`, the dataset is written next to `directory` and swapped in
+    once complete. Otherwise files with the same name are overwritten and the
+    others kept, so writes with their own `basename_template` add to it.
+    """
+    target = directory + '.tmp' if replace else directory
+    if replace and os.path.exists(target):
+        shutil.rmtree(target)
+    ds.write_dataset(
+        batches, target, schema=schema, format='parquet',
+        partitioning=ds.partitioning(pa.schema([schema.field(name) for name in partition_cols]),
+                                     flavor='hive'),
+        basename_template=basename_template,
+        existing_data_behavior='overwrite_or_ignore',
+    )
+    if replace:
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(target, directory)
+
+def dataset_schema(directory):
+    """
+    Returns the schema of a Hive-partitioned dataset whose writes only ever
+    add columns, taken from its newest file, or None if there is none yet.
+    """
+    if not os.path.exists(directory):
+        return None
+    dataset = ds.dataset(directory, format='parquet', partitioning='hive')
+    if not dataset.files:
+        return None
+    schema = pq.read_schema(max(dataset.files, key=os.path.getmtime))
+    for field in dataset.partitioning.schema:
+        if field.name not in schema.names:
+            schema = schema.append(field)
+    return schema
+
+def conform_batch(batch, schema):
+    """Casts a record batch to `schema`, with null columns for the fields it lacks."""
+    columns = [
+        batch.column(field.name).cast(field.type) if field.name in batch.schema.names
+        else pa.nulls(batch.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def load_jsonl(filename):
+    """Load a JSON lines file into a DataFrame."""
+    return pd.DataFrame(list(read_jsonl(filename)))
+
+def _batch_schema(records):
+    # The struct type of the records covers the keys of all of them, not
+    # only the first one's as Table.from_pylist does
+    return pa.schema(list(pa.array(records).type))
+
+def infer_schema(records, batch_size=1000):
+    """
+    Infers one schema for all the records, a batch at a time, so columns
+    that are empty in the first records or only appear in later ones get
+    the type of their values. Integer columns holding floats become floats.
+    """
+    schemas = []
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            schemas.append(_batch_schema(batch))
+            batch = []
+    if batch:
+        schemas.append(_batch_schema(batch))
+    if not schemas:
+        return None
+    return pa.unify_schemas(schemas, promote_options='permissive')
+
+
+class ScrapeCache:
+    """
+    Append-only cache of scraped records, stored as a JSON lines log.
+    Each record is written once, and the keys of the scraped records are
+    kept in a set so lookups don't depend on the size of the cache.
+    """
+
+    def __init__(self, filename, key='url'):
+        self.filename = filename
+        self.key = key
+        self.keys = set(record[key] for record in read_jsonl(filename))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        truncate_torn_line(filename)
+        self._file = open(filename, 'a', encoding='utf-8')
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, record):
+        """Append a record to the log."""
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self._file.flush()
+        self.keys.add(record[self.key])
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def compact(self, filename, batch_size=1000):
+        """
+        Stream the cached records into a Parquet file, keeping the first record
+        of each key. The schema is inferred over the whole log first. Returns
+        the number of records written.
+        """
+        self.close()
+        schema = infer_schema(read_jsonl(self.filename), batch_size)
+        seen = set()
+        with ParquetSink(filename, schema, batch_size=batch_size) as sink:
+            for record in read_jsonl(self.filename):
+                if record[self.key] in seen:
+                    continue
+                seen.add(record[self.key])
+                sink.write(record)
+        return sink.rows
+
+
+class ParquetSink:
+    """
+    Streaming Parquet writer with bounded memory. Records are buffered and
+    written as a row group every `batch_size` records, to a temporary file
+    that replaces `filename` when the sink is closed.
+
+    Without a schema, it is inferred from the first row group; fields that
+    only appear later are dropped, and a column that is empty in it cannot
+    hold values later. Pass one, e.g. from infer_schema, unless the records
+    all have the same fields and types. `to_row` converts records to rows. Write
+    times, rows and bytes are recorded in `metrics` if given.
+    """
+
+    def __init__(self, filename, schema=None, batch_size=1000, to_row=None, metrics=None):
+        self.filename = filename
+        self.schema = schema
+        self.batch_size = batch_size
+        self.to_row = to_row
+        self.metrics = metrics
+        self.rows = 0
+        self._buffer = []
+        self._writer = None
+        self._tmp_filename = filename + '.tmp'
+
+    def write(self, record):
+        """Add a record, flushing a row group when the buffer is full."""
+        self._buffer.append(self.to_row(record) if self.to_row is not None else record)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_table(self, table):
+        """Write an Arrow table or record batch as it is, after the buffered records."""
+        self.flush()
+        if isinstance(table, pa.RecordBatch):
+            table = pa.Table.from_batches([table])
+        self._write(table)
+
+    def flush(self):
+        """Write the buffered records as a row group."""
+        if not self._buffer:
+            return
+        table = pa.Table.from_pylist(self._buffer, schema=self.schema)
+        self._buffer = []
+        self._write(table)
+
+    def _write(self, table):
+        start = time.perf_counter()
+        if self._writer is None:
+            if self.schema is None:
+                self.schema = table.schema
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            self._writer = pq.ParquetWriter(self._tmp_filename, self.schema)
+        self._writer.write_table(table.cast(self.schema))
+        self.rows += table.num_rows
+        if self.metrics is not None:
+            self.metrics.observe('stage_seconds', time.perf_counter() - start, stage='parquet_write')
+            self.metrics.inc('rows_written', table.num_rows)
+
+    def close(self):
+        """Flush the buffer and move the finished file into place."""
+        self.flush()
+        if self._writer is None:
+            # Nothing was written, leave an empty file behind
+            pq.write_table(pa.table({}) if self.schema is None else self.schema.empty_table(),
+                           self._tmp_filename)
+        else:
+            self._writer.close()
+        os.replace(self._tmp_filename, self.filename)
+        if self.metrics is not None:
+            self.metrics.inc('bytes', os.path.getsize(self.filename), source='parquet')
+
+    def abort(self):
+        """Drop the temporary file, leaving `filename` untouched."""
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()